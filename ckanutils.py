@@ -14,43 +14,2058 @@ Examples:
 
 Attributes:
     CKAN_KEYS (List[str]): available CKAN keyword arguments.
+    INTERNAL_FIELDS (List[str]): datastore fields that aren't replicated.
+    SHORTCUTS (dict): CKAN attribute names and the action they call.
 """
 
 from __future__ import (
     absolute_import, division, print_function, with_statement,
     unicode_literals)
 
+import os
+import re
+import bz2
+import gzip
+import json
+import mmap
+import time
+import random
+import shelve
+import hashlib
+import zipfile
+import pstats
+import cProfile
 import requests
 import ckanapi
+import threading
 import itertools as it
 
 from os import environ, path as p
-from datetime import datetime as dt
+from datetime import datetime as dt, timedelta
 from operator import itemgetter
+from functools import partial
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from email.utils import parsedate_tz, mktime_tz
+from contextlib import contextmanager
 from pprint import pprint
 
-from ckanapi import NotFound, NotAuthorized, ValidationError
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+from ckanapi import NotFound, NotAuthorized, ValidationError, CKANAPIError
 from tabutils import process as pr, io, fntools as ft, convert as cv
 
-__version__ = '0.14.9'
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import tracemalloc as _tracemalloc
+except ImportError:
+    _tracemalloc = None
+
+try:
+    from resource import getrusage, RUSAGE_SELF
+except ImportError:
+    getrusage = None
+
+__version__ = '0.14.9'
+
+__title__ = 'ckanutils'
+__author__ = 'Reuben Cummings'
+__description__ = 'Miscellaneous CKAN utility library'
+__email__ = 'reubano@gmail.com'
+__license__ = 'MIT'
+__copyright__ = 'Copyright 2015 Reuben Cummings'
+
+CKAN_KEYS = [
+    'hash_table', 'remote', 'api_key', 'ua', 'force', 'quiet', 'metrics',
+    'retry', 'rate_limit', 'cache']
+API_KEY_ENV = 'CKAN_API_KEY'
+REMOTE_ENV = 'CKAN_REMOTE_URL'
+UA_ENV = 'CKAN_USER_AGENT'
+DEF_USER_AGENT = 'ckanutils/%s' % __version__
+DEF_HASH_PACK = 'hash-table'
+DEF_HASH_RES = 'hash-table.csv'
+CHUNKSIZE_ROWS = 10 ** 3
+CHUNKSIZE_ROWS_LOCAL = 10 ** 4
+CHUNKSIZE_BYTES = 2 ** 20
+HASH_BLOCKSIZE = 2 ** 23
+XLSX_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+XLSX_REL_NS = (
+    'http://schemas.openxmlformats.org/officeDocument/2006/relationships')
+XLSX_PKG_REL_NS = (
+    'http://schemas.openxmlformats.org/package/2006/relationships')
+XLSX_DATE_FORMATS = set(range(14, 23)) | set(range(45, 48))
+CACHE_BYTES = 2 ** 26
+CACHE_TTL = 300
+NULL_VALUES = ['', 'null', 'none', 'nan', 'n/a']
+NULL_VARIANTS = sorted(
+    ''.join(chars) for value in NULL_VALUES
+    for chars in it.product(*[{c.lower(), c.upper()} for c in value]))
+BOOL_VALUES = ['true', 'false']
+DATE_DIGITS = [0, 1, 2, 3, 5, 6, 8, 9]
+TIME_DIGITS = [11, 12, 14, 15]
+VECTOR_TYPES = ['bool', 'int', 'float', 'date', 'datetime']
+COMPRESSIONS = ['gz', 'bz2', 'xz', 'zip']
+MAGIC_NUMBERS = [
+    (b'\x1f\x8b', 'gz'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'xz'),
+    (b'PK\x03\x04', 'zip')]
+ENCODING = 'utf-8'
+NETWORK_STAGES = ['upsert']
+INTERNAL_FIELDS = ['_id', '_full_text']
+DEFINITION_KEYS = ['aliases', 'indexes']
+
+# datastore_search reports postgres type names
+FIELD_TYPES = {
+    'int': 'int4', 'integer': 'int4', 'bigint': 'int8', 'float': 'float8',
+    'double': 'float8', 'string': 'text', 'boolean': 'bool',
+    'datetime': 'timestamp'}
+RETRY_STATUSES = [429, 502, 503, 504]
+THROTTLE_STATUSES = [429, 503]
+
+# actions that may create duplicates if resent after the server committed them
+UNSAFE_ACTIONS = ['resource_create', 'package_create', 'resource_upload']
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+SHORTCUTS = {
+    'datastore_search': 'datastore_search',
+    'datastore_create': 'datastore_create',
+    'datastore_delete': 'datastore_delete',
+    'datastore_upsert': 'datastore_upsert',
+    'datastore_search_sql': 'datastore_search_sql',
+    'resource_show': 'resource_show',
+    'resource_create': 'resource_create',
+    'resource_update': 'resource_update',
+    'resource_delete': 'resource_delete',
+    'package_create': 'package_create',
+    'package_update': 'package_update',
+    'package_privatize': 'bulk_update_private',
+    'revision_show': 'revision_show',
+    'activity_list': 'recently_changed_packages_activity_list',
+    'organization_list': 'organization_list_for_user',
+    'organization_show': 'organization_show',
+    'license_list': 'license_list',
+    'group_list': 'group_list',
+}
+
+
+def _is_nested(value):
+    return hasattr(value, 'read') or isinstance(value, dict)
+
+
+def _size(obj):
+    """Estimates the number of bytes an object occupies on the wire.
+
+    Args:
+        obj (obj): A requests.Response, file like object, or json
+            serializable object.
+
+    Returns:
+        int: The estimated number of bytes.
+
+    Examples:
+        >>> _size({'id': 'rid'})
+        13
+        >>> _size(None)
+        0
+    """
+    if obj is None:
+        return 0
+    elif hasattr(obj, 'status_code'):
+        # don't touch `content` since that would consume a streamed response
+        return int(obj.headers.get('content-length') or 0)
+    elif hasattr(obj, 'read'):
+        try:
+            pos = obj.tell()
+            obj.seek(0, 2)
+            size = obj.tell()
+            obj.seek(pos)
+        except (AttributeError, IOError, OSError):
+            size = 0
+
+        return size
+    elif isinstance(obj, dict):
+        nested = [v for v in obj.values() if _is_nested(v)]
+        rest = {k: v for k, v in obj.items() if not _is_nested(v)}
+        size = len(json.dumps(rest, default=str)) if rest else 0
+        return size + sum(map(_size, nested))
+    elif isinstance(obj, (bytes, type(''))):
+        return len(obj)
+    else:
+        return len(json.dumps(obj, default=str))
+
+
+class Metrics(object):
+    """Collects latency, transfer size, retry and error stats per action.
+
+    Attributes:
+        hooks (List[func]): Callbacks that receive each recorded event.
+        buckets (List[float]): Upper bounds (in seconds) of the latency
+            histogram buckets.
+    """
+
+    def __init__(self, hooks=None, buckets=None):
+        """Initialization method.
+
+        Kwargs:
+            hooks (List[func]): Callbacks that receive each recorded event
+                (a dict with the keys `event` (either 'call' or 'retry'),
+                `action`, `latency`, `sent`, `received`, `retries`, and
+                `error`).
+            buckets (List[float]): Latency histogram bucket upper bounds in
+                seconds (default: LATENCY_BUCKETS).
+
+        Returns:
+            New instance of :class:`Metrics`
+
+        Examples:
+            >>> Metrics().snapshot()
+            {}
+        """
+        self.hooks = hooks or []
+        self.buckets = buckets or LATENCY_BUCKETS
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def record(self, action, latency, sent=0, received=0, **kwargs):
+        """Records a single action call.
+
+        Args:
+            action (str): The action name.
+            latency (float): Time taken in seconds.
+            sent (int): Number of request bytes.
+            received (int): Number of response bytes.
+
+        Kwargs:
+            retries (int): Number of retries performed.
+            error (str): The error class name if the call failed.
+
+        Examples:
+            >>> metrics = Metrics()
+            >>> metrics.record('resource_show', 0.02, 10, 100)
+            >>> metrics.snapshot()['resource_show']['latency']['count']
+            1
+        """
+        retries = kwargs.get('retries', 0)
+        error = kwargs.get('error')
+
+        with self.lock:
+            stat = self._get_stat(action, latency)
+            stat['calls'] += 1
+            stat['sent'] += sent
+            stat['received'] += received
+            stat['retries'] += retries
+
+            if error:
+                stat['errors'][error] = stat['errors'].get(error, 0) + 1
+
+            lat = stat['latency']
+            lat['count'] += 1
+            lat['total'] += latency
+            lat['min'] = min(latency, lat['min'])
+            lat['max'] = max(latency, lat['max'])
+            pos = sum(1 for bound in self.buckets if latency > bound)
+            lat['histogram'][pos] += 1
+
+        self._emit(
+            'call', action, latency=latency, sent=sent, received=received,
+            retries=retries, error=error)
+
+    def _emit(self, name, action, **kwargs):
+        event = {
+            'event': name, 'action': action, 'latency': 0, 'sent': 0,
+            'received': 0, 'retries': 0, 'error': None}
+
+        event.update(kwargs)
+
+        for hook in self.hooks:
+            hook(event)
+
+    def _get_stat(self, action, latency=0):
+        if action not in self.stats:
+            self.stats[action] = {
+                'calls': 0, 'sent': 0, 'received': 0, 'retries': 0,
+                'errors': {}, 'latency': {
+                    'count': 0, 'total': 0, 'min': latency, 'max': latency,
+                    'histogram': [0] * (len(self.buckets) + 1)}}
+
+        return self.stats[action]
+
+    def retried(self, action):
+        """Counts a single retry of an action call (and passes a `retry`
+        event to the hooks).
+
+        Examples:
+            >>> events = []
+            >>> metrics = Metrics(hooks=[events.append])
+            >>> metrics.retried('datastore_upsert')
+            >>> metrics.snapshot()['datastore_upsert']['retries']
+            1
+            >>> events[0]['event'], events[0]['retries']
+            (u'retry', 1)
+        """
+        with self.lock:
+            self._get_stat(action)['retries'] += 1
+
+        self._emit('retry', action, retries=1)
+
+    def measure(self, action, func, *args, **kwargs):
+        """Calls `func` and records its latency, transfer size, and errors.
+
+        Args:
+            action (str): The action name.
+            func (func): The function to call.
+            *args: Positional arguments that are passed to `func`.
+            **kwargs: Keyword arguments that are passed to `func`.
+
+        Returns:
+            obj: The result of `func`.
+
+        Examples:
+            >>> metrics = Metrics()
+            >>> metrics.measure('echo', lambda **kw: kw['id'], id='rid')
+            u'rid'
+            >>> metrics.snapshot()['echo']['sent']
+            13
+        """
+        sent = _size(kwargs)
+        start = time.time()
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception as err:
+            latency = time.time() - start
+            name = err.__class__.__name__
+            self.record(action, latency, sent, error=name)
+            raise
+        else:
+            latency = time.time() - start
+            self.record(action, latency, sent, _size(result))
+            return result
+
+    def snapshot(self):
+        """Returns a copy of the collected stats keyed by action name.
+
+        Returns:
+            dict: The stats. Latency histogram buckets are keyed by their
+                upper bound (in seconds).
+
+        Examples:
+            >>> metrics = Metrics(buckets=[1])
+            >>> metrics.record('resource_show', 0.5)
+            >>> metrics.snapshot()['resource_show']['latency']['histogram']
+            {u'1': 1, u'+Inf': 0}
+        """
+        bounds = ['%g' % b for b in self.buckets] + ['+Inf']
+
+        with self.lock:
+            snapshot = {}
+
+            for action, stat in self.stats.items():
+                latency = dict(stat['latency'])
+                count = latency['count']
+                latency['mean'] = latency['total'] / count if count else 0
+                latency['histogram'] = dict(zip(bounds, latency['histogram']))
+                snapshot[action] = dict(stat, latency=latency)
+                snapshot[action]['errors'] = dict(stat['errors'])
+
+        return snapshot
+
+    def reset(self):
+        """Clears all collected stats."""
+        with self.lock:
+            self.stats = {}
+
+
+def hash_file(filepath, algorithm='md5', blocksize=HASH_BLOCKSIZE):
+    """Hashes a file by memory mapping it and digesting it in large blocks.
+
+    Args:
+        filepath (str): The file to hash.
+        algorithm (str): A hashlib algorithm name (default: 'md5').
+        blocksize (int): Number of bytes to digest at a time.
+
+    Returns:
+        str: The hex digest.
+
+    Examples:
+        >>> from tempfile import NamedTemporaryFile
+        >>> with NamedTemporaryFile() as f:
+        ...     hash_file(f.name)
+        u'd41d8cd98f00b204e9800998ecf8427e'
+    """
+    hasher = hashlib.new(algorithm)
+
+    with open(filepath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+
+        if size:
+            # can't mmap empty files
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            try:
+                for pos in range(0, size, blocksize):
+                    hasher.update(mapped[pos:pos + blocksize])
+            finally:
+                mapped.close()
+
+    return '%s' % hasher.hexdigest()
+
+
+def _hash_files(files, algorithm='md5', workers=4):
+    """Hashes files concurrently.
+
+    Args:
+        files (dict): The file paths keyed by name.
+        algorithm (str): A hashlib algorithm name (default: 'md5').
+        workers (int): Max number of files to hash at once (default: 4).
+
+    Returns:
+        dict: The hashes keyed by name.
+    """
+    names = list(files)
+    hasher = partial(hash_file, algorithm=algorithm)
+    pool = ThreadPool(workers)
+
+    try:
+        return dict(zip(names, pool.map(hasher, map(files.get, names))))
+    finally:
+        pool.close()
+
+
+def get_compression(filepath):
+    """Detects a file's compression by its extension or magic number. Zipped
+    office documents, e.g., xlsx files, aren't considered compressed.
+
+    Args:
+        filepath (str): The file path.
+
+    Returns:
+        str: The compression (one of COMPRESSIONS), `None` if uncompressed.
+
+    Examples:
+        >>> get_compression('file.csv.gz')
+        u'gz'
+        >>> get_compression('file.csv')
+    """
+    try:
+        extension = p.splitext(filepath)[1].lstrip('.').lower()
+    except (AttributeError, TypeError):
+        # not a file path, e.g., a file like object
+        return None
+
+    try:
+        with open(filepath, 'rb') as f:
+            header = f.read(8)
+    except (IOError, OSError, TypeError):
+        compression = extension if extension in COMPRESSIONS else None
+    else:
+        matches = (c for magic, c in MAGIC_NUMBERS if header.startswith(magic))
+        compression = next(matches, None)
+
+    if compression == 'zip' and p.exists(filepath):
+        with zipfile.ZipFile(filepath) as zf:
+            if '[Content_Types].xml' in zf.namelist():
+                compression = None
+
+    return compression
+
+
+def open_compressed(filepath, compression):
+    """Opens a compressed file for streaming decompression.
+
+    Args:
+        filepath (str): The file path.
+        compression (str): The compression (one of COMPRESSIONS).
+
+    Returns:
+        tuple: (f, filename) where `f` is a file like object of decompressed
+            content and `filename` is the name of the decompressed file,
+            e.g., `file.csv` for `file.csv.gz`.
+
+    Raises:
+        TypeError: If `compression` isn't supported, or a zip file doesn't
+            contain exactly one file.
+    """
+    if compression == 'zip':
+        zf = zipfile.ZipFile(filepath)
+        members = [i for i in zf.infolist() if not i.filename.endswith('/')]
+
+        if len(members) != 1:
+            zf.close()
+            msg = 'Zip file `%s` must contain exactly one file.' % filepath
+            raise TypeError(msg)
+
+        return zf.open(members[0]), members[0].filename
+
+    if compression == 'gz':
+        f = gzip.open(filepath, 'rb')
+    elif compression == 'bz2':
+        f = bz2.BZ2File(filepath, 'rb')
+    elif compression == 'xz' and lzma:
+        f = lzma.open(filepath, 'rb')
+    else:
+        raise TypeError('Compression `%s` is not supported.' % compression)
+
+    root, extension = p.splitext(filepath)
+    return f, root if extension.lstrip('.') == compression else filepath
+
+
+def _to_array(values):
+    """Converts a column of values to a stripped unicode array and a mask of
+    its null values.
+    """
+    strings = np.char.strip(np.array(
+        ['' if v is None else '%s' % v for v in values], dtype='U'))
+
+    # matching every casing of the null values skips lowercasing the column
+    return strings, np.isin(strings, NULL_VARIANTS)
+
+
+def _has_digits(chars, positions):
+    digits = chars[:, positions]
+    return ((digits >= '0') & (digits <= '9')).all()
+
+
+def _is_iso(strings, datetime=False):
+    """Determines whether all values of a (non null) unicode array are full
+    ISO 8601 dates, e.g., '2016-05-01', or datetimes, e.g., '2016-05-01T12:30'.
+    NumPy also parses 'today', 'now', 'NaT', '2015', and '2016-05'.
+
+    Examples:
+        >>> _is_iso(np.array(['2016-05-01', '2016-05-01 12:30:15']), True)
+        True
+        >>> _is_iso(np.array(['2016-05-01', '2016-05']))
+        False
+        >>> _is_iso(np.array(['2016-05-01', 'today']), True)
+        False
+    """
+    lengths = np.char.str_len(strings)
+    width = 16 if datetime else 10
+
+    if lengths.min() < 10 or (lengths.max() > 10 and not datetime):
+        return False
+
+    chars = strings.astype('U%i' % width).view('U1').reshape(-1, width)
+    is_date = _has_digits(chars, DATE_DIGITS) and (
+        chars[:, [4, 7]] == '-').all()
+
+    # datetimes may also hold dates (midnight)
+    timed = chars[lengths > 10]
+
+    if not (is_date and len(timed)):
+        return is_date
+    elif lengths[lengths > 10].min() < 16:
+        return False
+
+    is_time = np.isin(timed[:, 10], ['T', ' ']).all()
+    return is_time and _has_digits(timed, TIME_DIGITS) and (
+        timed[:, 13] == ':').all()
+
+
+def _parse_array(strings, ftype):
+    """Parses a (non null) unicode array as `ftype`.
+
+    Returns:
+        obj: numpy array
+
+    Raises:
+        ValueError: If any value can't be parsed as `ftype`.
+        OverflowError: If a date(time) is out of range.
+    """
+    if ftype == 'bool':
+        lowered = np.char.lower(strings)
+
+        if not np.isin(lowered, BOOL_VALUES).all():
+            raise ValueError('Not a boolean')
+
+        return lowered == 'true'
+    elif ftype == 'int':
+        return _parse_ints(strings)
+    elif ftype == 'float':
+        floats = strings.astype(np.float64)
+
+        if not np.isfinite(floats).all():
+            raise ValueError('Not a finite float')
+
+        return floats
+    elif ftype == 'date':
+        if not _is_iso(strings):
+            raise ValueError('Not a date')
+
+        return strings.astype('datetime64[D]')
+    elif ftype == 'datetime':
+        if not _is_iso(strings, True):
+            raise ValueError('Not a datetime')
+
+        return strings.astype('datetime64[us]')
+    else:
+        return strings
+
+
+def _parse_ints(strings):
+    try:
+        return strings.astype(np.int64)
+    except OverflowError:
+        # keep integers that don't fit in int64 (e.g., long ids) exact
+        return np.array([int(s) for s in strings.tolist()], dtype=object)
+
+
+def _parse_valid(strings, ftype):
+    """Parses a (non null) unicode array as `ftype`, splitting it in half
+    until each value that can't be parsed is isolated and nulled. So a few
+    bad values only cost a few extra parses instead of one per value.
+
+    Examples:
+        >>> _parse_valid(np.array(['1', 'x', '3']), 'int')
+        [1, None, 3]
+    """
+    if not len(strings):
+        return []
+
+    try:
+        return _parse_array(strings, ftype).tolist()
+    except (ValueError, OverflowError):
+        if len(strings) == 1:
+            return [None]
+
+    half = len(strings) // 2
+    parsed = _parse_valid(strings[:half], ftype)
+    return parsed + _parse_valid(strings[half:], ftype)
+
+
+def _cast_column(values, ftype):
+    """Casts a column of values to `ftype` all at once. Nulls and values that
+    can't be cast become `None`. Text values are passed through as is.
+
+    Examples:
+        >>> _cast_column([' None ', ' x '], 'text')
+        [u' None ', u' x ']
+        >>> _cast_column(['12345678901234567890123', 'n/a'], 'int')
+        [12345678901234567890123L, None]
+        >>> _cast_column(['2016-05-01', 'today', 'NaT', '2016-05'], 'date')
+        [datetime.date(2016, 5, 1), None, None, None]
+    """
+    if ftype not in VECTOR_TYPES:
+        return list(values)
+
+    strings, nulls = _to_array(values)
+
+    if not nulls.any():
+        return _parse_valid(strings, ftype)
+
+    casted = [None] * len(strings)
+    indexes = np.flatnonzero(~nulls)
+
+    for pos, value in zip(indexes.tolist(), _parse_valid(
+            strings[indexes], ftype)):
+        casted[pos] = value
+
+    return casted
+
+
+def vectorized_detect_types(records, sample_size=CHUNKSIZE_ROWS):
+    """Detects the field types of records by parsing a sample of each column
+    at once with NumPy. Falls back to `tabutils.process.detect_types` if
+    NumPy isn't installed.
+
+    Args:
+        records (Iter[dict]): Rows of data whose keys are the field names.
+        sample_size (int): Number of rows to detect the types from.
+
+    Returns:
+        tuple: (records, result) where `records` is an iterator of the
+            original records and `result` is a dict whose `types` key is the
+            list of detected fields, e.g., [{'id': 'field', 'type': 'int'}].
+
+    Examples:
+        >>> records = [{'a': '1', 'b': '1.5'}, {'a': '', 'b': 'x'}]
+        >>> records, result = vectorized_detect_types(records)
+        >>> sorted((t['id'], t['type']) for t in result['types'])
+        [(u'a', u'int'), (u'b', u'text')]
+        >>> big = '12345678901234567890123'
+        >>> records = [
+        ...     {'id': big, 'a': '1', 'b': '1.5', 'c': 'x'},
+        ...     {'id': '1', 'a': '2', 'b': '2.25', 'c': 'y'}]
+        >>> get_types = lambda result: sorted(
+        ...     (t['id'], t['type']) for t in result['types'])
+        >>> result = vectorized_detect_types(records)[1]
+        >>> get_types(result) == get_types(pr.detect_types(records)[1])
+        True
+        >>> get_types(result)
+        [(u'a', u'int'), (u'b', u'float'), (u'c', u'text'), (u'id', u'int')]
+    """
+    if np is None:
+        return pr.detect_types(records)
+
+    records = iter(records)
+    sample = list(it.islice(records, sample_size))
+    keys = list(sample[0].keys()) if sample else []
+    types = []
+
+    for key in keys:
+        strings, nulls = _to_array([r.get(key) for r in sample])
+        strings = strings[~nulls]
+
+        for ftype in VECTOR_TYPES if len(strings) else []:
+            try:
+                _parse_array(strings, ftype)
+            except (ValueError, OverflowError):
+                continue
+            else:
+                break
+        else:
+            ftype = 'text'
+
+        types.append({'id': key, 'type': ftype})
+
+    return it.chain(sample, records), {'types': types}
+
+
+def vectorized_type_cast(records, types, batchsize=CHUNKSIZE_ROWS):
+    """Casts records to the given field types a batch of columns at a time
+    with NumPy. Falls back to `tabutils.process.type_cast` if NumPy isn't
+    installed.
+
+    Args:
+        records (Iter[dict]): Rows of data whose keys are the field names.
+        types (List[dict]): Field types as returned by
+            `vectorized_detect_types`.
+        batchsize (int): Number of rows to cast at a time.
+
+    Yields:
+        dict: The casted record.
+
+    Examples:
+        >>> types = [{'id': 'a', 'type': 'int'}]
+        >>> list(vectorized_type_cast([{'a': '1'}, {'a': ''}], types))
+        [{u'a': 1}, {u'a': None}]
+    """
+    if np is None:
+        for record in pr.type_cast(records, types):
+            yield record
+
+        return
+
+    records = iter(records)
+    keys = [t['id'] for t in types]
+    ftypes = [t['type'] for t in types]
+
+    while True:
+        batch = list(it.islice(records, batchsize))
+
+        if not batch:
+            break
+
+        columns = [
+            _cast_column([r.get(key) for r in batch], ftype)
+            for key, ftype in zip(keys, ftypes)]
+
+        for values in zip(*columns):
+            yield dict(zip(keys, values))
+
+
+def _xlsx_tag(name, ns=XLSX_NS):
+    return '{%s}%s' % (ns, name)
+
+
+def _xlsx_column(ref):
+    """Converts a cell reference to a (zero indexed) column number.
+
+    Examples:
+        >>> _xlsx_column('AB12')
+        27
+    """
+    letters = re.match('[A-Z]+', ref).group()
+    return sum(
+        (ord(l) - 64) * 26 ** i for i, l in enumerate(reversed(letters))) - 1
+
+
+def _is_date_format(code):
+    """Determines whether an xlsx number format code formats dates.
+
+    Examples:
+        >>> _is_date_format('yyyy-mm-dd')
+        True
+        >>> _is_date_format('[Red]#,##0.00')
+        False
+    """
+    code = re.sub(r'"[^"]*"|\[[^\]]*\]|\\.', '', code)
+    return bool(re.search('[dmyhs]', code, re.I))
+
+
+def _xlsx_sheet_path(zf, sheet):
+    """Gets the zip member path of a worksheet by (zero indexed) position or
+    name.
+    """
+    workbook = ET.parse(zf.open('xl/workbook.xml')).getroot()
+    sheets = workbook.find(_xlsx_tag('sheets'))
+    rels = ET.parse(zf.open('xl/_rels/workbook.xml.rels')).getroot()
+    tag = _xlsx_tag('Relationship', XLSX_PKG_REL_NS)
+    targets = {r.get('Id'): r.get('Target') for r in rels.iter(tag)}
+    id_tag = _xlsx_tag('id', XLSX_REL_NS)
+    attrs = [(s.get('name'), s.get(id_tag)) for s in sheets]
+
+    try:
+        rel_id = dict(attrs)[sheet] if sheet in dict(attrs) else (
+            attrs[int(sheet)][1])
+    except (IndexError, ValueError):
+        raise TypeError('Sheet `%s` was not found in workbook.' % sheet)
+
+    target = targets[rel_id]
+    return target.lstrip('/') if target.startswith('/') else 'xl/' + target
+
+
+def _xlsx_date_styles(zf):
+    """Gets the (cellXfs) style indexes that format dates."""
+    try:
+        styles = ET.parse(zf.open('xl/styles.xml')).getroot()
+    except KeyError:
+        return set()
+
+    custom = styles.find(_xlsx_tag('numFmts'))
+    date_ids = set(XLSX_DATE_FORMATS)
+
+    for fmt in [] if custom is None else custom:
+        if _is_date_format(fmt.get('formatCode', '')):
+            date_ids.add(int(fmt.get('numFmtId')))
+
+    xfs = styles.find(_xlsx_tag('cellXfs'))
+    xfs = [] if xfs is None else xfs
+    return {
+        pos for pos, xf in enumerate(xfs)
+        if int(xf.get('numFmtId', 0)) in date_ids}
+
+
+def _xlsx_shared_strings(zf):
+    """Incrementally parses the shared strings table."""
+    strings = []
+
+    try:
+        f = zf.open('xl/sharedStrings.xml')
+    except KeyError:
+        return strings
+
+    si_tag, t_tag = _xlsx_tag('si'), _xlsx_tag('t')
+
+    for _, elem in ET.iterparse(f):
+        if elem.tag == si_tag:
+            strings.append(''.join(t.text or '' for t in elem.iter(t_tag)))
+            elem.clear()
+
+    return strings
+
+
+def _xlsx_value(cell, strings, date_styles, epoch):
+    """Parses the value of an xlsx cell element."""
+    ctype = cell.get('t', 'n')
+    value = cell.findtext(_xlsx_tag('v'))
+
+    if ctype == 'inlineStr':
+        value = ''.join(t.text or '' for t in cell.iter(_xlsx_tag('t')))
+    elif value is None or ctype == 'e':
+        value = None
+    elif ctype == 's':
+        value = strings[int(value)]
+    elif ctype == 'b':
+        value = value == '1'
+    elif ctype == 'n' and int(cell.get('s', 0)) in date_styles:
+        value = epoch + timedelta(days=float(value))
+    elif ctype == 'n':
+        value = float(value)
+        value = int(value) if value.is_integer() else value
+
+    return value
+
+
+def read_xlsx(filepath, sheet=0, **kwargs):
+    """Reads an xlsx worksheet row by row, incrementally parsing its xml so
+    that memory use doesn't depend on the worksheet size (only the shared
+    strings table is held in memory).
+
+    Args:
+        filepath (str): The xlsx file path.
+        sheet (int or str): The (zero indexed) position or the name of the
+            worksheet to read (default: 0).
+        **kwargs: Keyword arguments.
+
+    Kwargs:
+        first_row (int): The (zero indexed) row containing the header
+            (default: 0).
+
+    Yields:
+        dict: A row of data whose keys are the (text) header values. Whole
+            numbers are ints, other numbers are floats, and date formatted
+            numbers are datetimes.
+
+    Raises:
+        TypeError: If the worksheet isn't found.
+
+    Examples:
+        >>> from tempfile import NamedTemporaryFile
+        >>> rel = '<Relationship Id="r1" Target="worksheets/sheet1.xml"/>'
+        >>> rows = [
+        ...     '<c t="inlineStr"><is><t>name</t></is></c><c><v>2015</v></c>',
+        ...     '<c t="inlineStr"><is><t>a</t></is></c><c><v>3</v></c>',
+        ...     '<c t="inlineStr"><is><t>b</t></is></c><c><v>1.5</v></c>']
+        >>> members = {
+        ...     'xl/workbook.xml': (
+        ...         '<workbook xmlns="%s" xmlns:r="%s"><sheets><sheet '
+        ...         'name="s" r:id="r1"/></sheets></workbook>' % (
+        ...             XLSX_NS, XLSX_REL_NS)),
+        ...     'xl/_rels/workbook.xml.rels': (
+        ...         '<Relationships xmlns="%s">%s</Relationships>' % (
+        ...             XLSX_PKG_REL_NS, rel)),
+        ...     'xl/worksheets/sheet1.xml': (
+        ...         '<worksheet xmlns="%s"><sheetData>%s</sheetData>'
+        ...         '</worksheet>' % (XLSX_NS, ''.join(
+        ...             '<row>%s</row>' % r for r in rows)))}
+        >>> with NamedTemporaryFile(suffix='.xlsx') as f:
+        ...     with zipfile.ZipFile(f.name, 'w') as zf:
+        ...         for name, xml in members.items():
+        ...             zf.writestr(name, xml)
+        ...
+        ...     [sorted(row.items()) for row in read_xlsx(f.name)]
+        [[(u'2015', 3), (u'name', u'a')], [(u'2015', 1.5), (u'name', u'b')]]
+    """
+    first_row = kwargs.get('first_row', 0)
+
+    with zipfile.ZipFile(filepath) as zf:
+        path = _xlsx_sheet_path(zf, sheet)
+        date_styles = _xlsx_date_styles(zf)
+        strings = _xlsx_shared_strings(zf)
+        workbook = zf.read('xl/workbook.xml')
+        epoch = dt(1904, 1, 1) if b'date1904="1"' in workbook else (
+            dt(1899, 12, 30))
+
+        row_tag, c_tag = _xlsx_tag('row'), _xlsx_tag('c')
+        data_tag = _xlsx_tag('sheetData')
+        header, parent, row_num = None, None, -1
+
+        events = (str('start'), str('end'))
+
+        for event, elem in ET.iterparse(zf.open(path), events):
+            if event == 'start' and elem.tag == data_tag:
+                parent = elem
+
+            if event != 'end' or elem.tag != row_tag:
+                continue
+
+            values = {}
+
+            for pos, cell in enumerate(elem.iter(c_tag)):
+                ref = cell.get('r')
+                value = _xlsx_value(cell, strings, date_styles, epoch)
+                values[_xlsx_column(ref) if ref else pos] = value
+
+            row_num = int(elem.get('r', row_num + 2)) - 1
+
+            # free the parsed rows
+            elem.clear()
+            parent.clear() if parent is not None else None
+
+            if row_num < first_row or not values:
+                continue
+            elif header is None:
+                header = [
+                    '%s' % values[i] if values.get(i) not in {None, ''} else
+                    'column_%i' % (i + 1) for i in range(max(values) + 1)]
+            else:
+                yield {key: values.get(i) for i, key in enumerate(header)}
+
+
+def _closing(records, f):
+    """Closes `f` once `records` is exhausted (or garbage collected)."""
+    try:
+        for record in records:
+            yield record
+    finally:
+        f.close()
+
+
+def _put(queue, item, stop):
+    """Puts `item` in `queue` unless `stop` is set while waiting for room."""
+    while not stop.is_set():
+        try:
+            return queue.put(item, timeout=0.1)
+        except Full:
+            continue
+
+
+def prefetch(iterable, size=2):
+    """Reads ahead up to `size` items of `iterable` in a background thread,
+    e.g., to parse the next chunk of records while the current one is being
+    upserted.
+
+    Args:
+        iterable (iter): The items to read.
+        size (int): Max number of items to read ahead (default: 2).
+
+    Yields:
+        The items of `iterable`.
+
+    Examples:
+        >>> list(prefetch(iter([1, 2, 3])))
+        [1, 2, 3]
+    """
+    queue, stop, done = Queue(size), threading.Event(), object()
+
+    def fill():
+        try:
+            for item in iterable:
+                _put(queue, (None, item), stop)
+
+                if stop.is_set():
+                    break
+        except Exception as err:
+            _put(queue, (err, None), stop)
+        finally:
+            _put(queue, (None, done), stop)
+
+    filler = threading.Thread(target=fill)
+    filler.daemon = True
+    filler.start()
+
+    try:
+        while True:
+            err, item = queue.get()
+
+            if err:
+                raise err
+            elif item is done:
+                break
+
+            yield item
+    finally:
+        stop.set()
+
+
+def _get_definition(kwargs):
+    """Gets the `datastore_create` arguments that define a table besides its
+    fields.
+    """
+    definition = {}
+
+    for key in DEFINITION_KEYS:
+        value = kwargs.get(key) or []
+        value = value.split(',') if hasattr(value, 'split') else value
+        definition[key] = sorted(value)
+
+    return definition
+
+
+def _batch_filters(filters, batchsize=100):
+    """Splits the longest list valued filter into batches.
+
+    Args:
+        filters (dict): The datastore_delete filters (`None` for none).
+        batchsize (int): Max number of values per batch (default: 100).
+
+    Yields:
+        dict: The filters of each batch.
+
+    Examples:
+        >>> list(_batch_filters({'a': [1, 2, 3], 'b': 'x'}, 2)) == [
+        ...     {'a': [1, 2], 'b': 'x'}, {'a': [3], 'b': 'x'}]
+        True
+        >>> list(_batch_filters(None))
+        [None]
+    """
+    lists = [
+        (len(v), k) for k, v in (filters or {}).items()
+        if isinstance(v, (list, tuple))]
+
+    if lists:
+        key = max(lists)[1]
+        values = filters[key]
+
+        for i in range(0, len(values), batchsize):
+            yield dict(filters, **{key: list(values[i:i + batchsize])})
+    else:
+        yield filters
+
+
+def _field_type(field):
+    """Gets the normalized type of a field.
+
+    Examples:
+        >>> _field_type({'id': 'a', 'type': 'int'})
+        u'int4'
+    """
+    return FIELD_TYPES.get(field['type'], field['type'])
+
+
+def _compare_schema(schema, fields, definition):
+    """Determines how to update an existing datastore table to `fields`.
+
+    Args:
+        schema (dict): The table's schema as returned by `CKAN.get_schema`
+            (`None` if the table doesn't exist).
+        fields (List[dict]): The new fields/columns.
+        definition (dict): The new table definition.
+
+    Returns:
+        str: One of ['reused', 'altered', 'recreated'].
+
+    Examples:
+        >>> old = [{'id': 'a', 'type': 'int4'}]
+        >>> new = [{'id': 'a', 'type': 'int'}]
+        >>> definition = {'aliases': [], 'indexes': []}
+        >>> _compare_schema({'fields': old}, new, definition)
+        u'altered'
+        >>> schema = {'fields': old, 'definition': definition}
+        >>> _compare_schema(schema, new, definition)
+        u'reused'
+        >>> _compare_schema(schema, new + [{'id': 'b', 'type': 'text'}], {})
+        u'altered'
+        >>> _compare_schema(schema, [{'id': 'a', 'type': 'text'}], {})
+        u'recreated'
+    """
+    if not schema:
+        return 'recreated'
+
+    old = {f['id']: _field_type(f) for f in schema['fields']}
+    new = {f['id']: _field_type(f) for f in fields}
+
+    if any(new.get(key) != value for key, value in old.items()):
+        return 'recreated'
+    elif new == old and schema.get('definition') == definition:
+        return 'reused'
+    else:
+        return 'altered'
+
+
+def _retry_after(value):
+    """Parses a `Retry-After` header value.
+
+    Args:
+        value (str): The header value (either seconds or an HTTP date).
+
+    Returns:
+        float: Number of seconds to wait (`None` if `value` is empty or
+            invalid).
+
+    Examples:
+        >>> _retry_after('120')
+        120.0
+        >>> _retry_after('Wed, 21 Oct 2015 07:28:00 GMT')
+        0
+        >>> _retry_after(None)
+    """
+    if not value:
+        return None
+
+    try:
+        return float(value)
+    except ValueError:
+        parsed = parsedate_tz(value)
+
+    return max(0, mktime_tz(parsed) - time.time()) if parsed else None
+
+
+def _get_status(err):
+    """Gets the HTTP status code of an unrecognized ckanapi error.
+
+    Examples:
+        >>> _get_status(CKANAPIError("['http://ckan', 503, 'busy']"))
+        503
+        >>> _get_status(NotFound('Not found'))
+    """
+    if isinstance(err, CKANAPIError):
+        # ckanapi formats the message as `repr([url, status, response])` (and
+        # doesn't set `args` on python 2)
+        match = re.match(r"\[u?'[^']*', (\d{3}),", '%s' % err)
+        return int(match.group(1)) if match else None
+
+
+def _is_idempotent(action, kwargs):
+    """Determines whether an action call can safely be resent after the
+    server may have committed it.
+
+    Examples:
+        >>> _is_idempotent('datastore_upsert', {'method': 'insert'})
+        False
+        >>> _is_idempotent('datastore_upsert', {'method': 'upsert'})
+        True
+    """
+    if action == 'datastore_upsert':
+        return kwargs.get('method', 'upsert') != 'insert'
+    elif action == 'datastore_create':
+        # creates a new filestore resource
+        return 'resource' not in kwargs
+    else:
+        return action not in UNSAFE_ACTIONS
+
+
+def _site_url():
+    """Returns the site url of the CKAN instance running in process."""
+    from ckan.plugins.toolkit import config
+    return config.get('ckan.site_url', '')
+
+
+def _is_transport_error(err):
+    errors = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+    return isinstance(err, errors)
+
+
+def _rewind(obj):
+    """Rewinds any file like objects (possibly nested in a dict) so that a
+    failed upload can be resent.
+    """
+    if hasattr(obj, 'seek'):
+        obj.seek(0)
+    elif isinstance(obj, dict):
+        [_rewind(v) for v in obj.values()]
+
+
+class RateLimiter(object):
+    """Adaptive token bucket rate limiter.
+
+    The rate grows after each successful call (by `step` per second of
+    calls at the current rate) and is decreased multiplicatively whenever the
+    server signals it is overloaded. Concurrent calls rejected by the same
+    overload only decrease it once, since the rate isn't cut again until
+    `cooldown` seconds (or the server's `Retry-After`) have passed. A single
+    instance may be shared by multiple `CKAN` instances and threads.
+
+    Attributes:
+        rate (float): Current number of calls allowed per second.
+        burst (float): Max number of calls allowed at once.
+        min_rate (float): Lowest rate to adapt down to.
+        max_rate (float): Highest rate to adapt up to.
+        step (float): Fraction the rate grows by per second of successful
+            calls.
+        decrease (float): Rate multiplier after each throttled call.
+        cooldown (float): Min number of seconds between rate decreases.
+    """
+
+    def __init__(self, rate=10, **kwargs):
+        """Initialization method.
+
+        Args:
+            rate (float): Initial number of calls allowed per second
+                (default: 10).
+
+        Kwargs:
+            burst (float): Max number of calls allowed at once (default:
+                `rate`).
+            min_rate (float): Lowest rate to adapt down to (default: 0.1).
+            max_rate (float): Highest rate to adapt up to (default: 10 times
+                `rate`).
+            step (float): Fraction the rate grows by per second of
+                successful calls, i.e., each success multiplies the rate by
+                (1 + step) ** (1 / rate) (default: 0.2).
+            decrease (float): Rate multiplier after each throttled call
+                (default: 0.5).
+            cooldown (float): Min number of seconds between rate decreases,
+                e.g., the server's rate accounting window (default: 1, or
+                the time between two calls if longer).
+
+        Returns:
+            New instance of :class:`RateLimiter`
+
+        Examples:
+            >>> RateLimiter(5).rate
+            5.0
+        """
+        self.rate = float(rate)
+        self.burst = kwargs.get('burst', max(1, self.rate))
+        self.min_rate = kwargs.get('min_rate', 0.1)
+        self.max_rate = kwargs.get('max_rate', self.rate * 10)
+        self.step = kwargs.get('step', 0.2)
+        self.decrease = kwargs.get('decrease', 0.5)
+        self.cooldown = kwargs.get('cooldown', 1)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.paused_until = 0
+        self.cut_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a call is allowed."""
+        while True:
+            with self.lock:
+                now = time.time()
+                elapsed = now - self.updated
+                self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+                self.updated = now
+                wait = self.paused_until - now
+
+                if wait <= 0 and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = max(wait, (1 - self.tokens) / self.rate)
+
+            time.sleep(wait)
+
+    def success(self):
+        """Adapts to a successful call.
+
+        Examples:
+            >>> limiter = RateLimiter(1, step=0.5)
+            >>> limiter.success()
+            >>> limiter.rate
+            1.5
+        """
+        with self.lock:
+            growth = (1 + self.step) ** (1 / self.rate)
+            self.rate = min(self.max_rate, self.rate * growth)
+
+    def throttle(self, retry_after=None):
+        """Adapts to an overloaded server.
+
+        Args:
+            retry_after (float): Seconds the server asked us to wait.
+
+        Examples:
+            >>> limiter = RateLimiter(5)
+            >>> limiter.throttle()
+            >>> limiter.throttle()
+            >>> limiter.rate
+            2.5
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.tokens, 0)
+
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+
+            if now >= self.cut_until:
+                cooldown = max(self.cooldown, 1 / self.rate, retry_after or 0)
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self.cut_until = now + cooldown
+
+
+class RowBudget(object):
+    """Caps the number of rows in flight, i.e., read but not yet upserted,
+    across threads.
+
+    Attributes:
+        max_rows (int): Max number of rows in flight.
+        rows (int): Current number of rows in flight.
+        parent (obj): A :class:`RowBudget` the rows are also drawn from
+            (`None` if disabled).
+    """
+
+    def __init__(self, max_rows, parent=None):
+        """Initialization method.
+
+        Args:
+            max_rows (int): Max number of rows in flight.
+            parent (obj): A :class:`RowBudget` the rows are also drawn from,
+                e.g., a budget shared by several hosts (default: None).
+
+        Returns:
+            New instance of :class:`RowBudget`
+
+        Examples:
+            >>> RowBudget(100).max_rows
+            100
+        """
+        self.max_rows = max_rows
+        self.parent = parent
+        self.rows = 0
+        self.cond = threading.Condition()
+
+    def _cap(self, rows):
+        rows = min(rows, self.max_rows)
+        return self.parent._cap(rows) if self.parent else rows
+
+    def acquire(self, rows):
+        """Blocks until `rows` more rows are allowed in flight.
+
+        Args:
+            rows (int): Number of rows. Capped at `max_rows` (and the
+                parent's) so that a chunk larger than the budget can't block
+                forever.
+
+        Returns:
+            int: The number of rows acquired (pass to `release`).
+
+        Examples:
+            >>> budget = RowBudget(100)
+            >>> budget.acquire(150)
+            100
+            >>> budget.rows
+            100
+            >>> shared = RowBudget(100)
+            >>> RowBudget(200, parent=shared).acquire(150)
+            100
+            >>> shared.rows
+            100
+        """
+        rows = self._cap(rows)
+
+        with self.cond:
+            while self.rows + rows > self.max_rows:
+                self.cond.wait()
+
+            self.rows += rows
+
+        # acquire the parent's rows last so a full host budget only blocks
+        # jobs of that host
+        return self.parent.acquire(rows) if self.parent else rows
+
+    def release(self, rows):
+        """Marks `rows` rows as no longer in flight.
+
+        Args:
+            rows (int): Number of rows returned by `acquire`.
+
+        Examples:
+            >>> budget = RowBudget(100)
+            >>> budget.release(budget.acquire(10))
+            >>> budget.rows
+            0
+        """
+        with self.cond:
+            self.rows -= rows
+            self.cond.notify_all()
+
+        if self.parent:
+            self.parent.release(rows)
+
+
+class RetryPolicy(object):
+    """Retries failed calls with exponential backoff and jitter.
+
+    Retries connection errors, timeouts, and responses whose status is in
+    `statuses`. Non idempotent calls (see `call`) are only retried if the
+    server rejected them with a status in THROTTLE_STATUSES, unless `unsafe`
+    is set. The `Retry-After` header is honored for HTTP transfers (ckanapi
+    doesn't expose response headers for action calls).
+
+    Attributes:
+        retries (int): Max number of retries per call.
+        backoff (float): Initial backoff in seconds.
+        max_backoff (float): Max backoff in seconds.
+        jitter (bool): Randomize each backoff (full jitter).
+        statuses (List[int]): HTTP status codes to retry.
+        unsafe (bool): Retry non idempotent calls on any retryable failure.
+    """
+
+    def __init__(self, retries=5, backoff=0.5, max_backoff=60, **kwargs):
+        """Initialization method.
+
+        Args:
+            retries (int): Max number of retries per call (default: 5).
+            backoff (float): Initial backoff in seconds (default: 0.5).
+            max_backoff (float): Max backoff in seconds (default: 60).
+
+        Kwargs:
+            jitter (bool): Randomize each backoff (default: True).
+            statuses (List[int]): HTTP status codes to retry (default:
+                RETRY_STATUSES).
+            unsafe (bool): Retry non idempotent calls on connection errors,
+                timeouts, and gateway errors too, which may create duplicate
+                resources or records (default: False).
+
+        Returns:
+            New instance of :class:`RetryPolicy`
+
+        Examples:
+            >>> RetryPolicy(3).retries
+            3
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = kwargs.get('jitter', True)
+        self.statuses = kwargs.get('statuses', RETRY_STATUSES)
+        self.unsafe = kwargs.get('unsafe', False)
+
+    def delay(self, attempt, retry_after=None):
+        """Gets the number of seconds to wait before the next retry.
+
+        Args:
+            attempt (int): The number of the failed attempt (zero indexed).
+            retry_after (float): Seconds the server asked us to wait.
+
+        Returns:
+            float: The delay.
+
+        Examples:
+            >>> policy = RetryPolicy(jitter=False)
+            >>> policy.delay(3)
+            4.0
+            >>> policy.delay(3, retry_after=10)
+            10
+        """
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+
+        delay = min(self.max_backoff, self.backoff * 2.0 ** attempt)
+        return random.uniform(0, delay) if self.jitter else delay
+
+    def classify(self, err, idempotent=True):
+        """Determines whether a failed call should be retried.
+
+        Args:
+            err (obj): The raised exception.
+            idempotent (bool): The call can safely be resent (default: True).
+
+        Returns:
+            tuple: (retryable, status)
+
+        Examples:
+            >>> RetryPolicy().classify(NotFound('Not found'))
+            (False, None)
+            >>> err = requests.exceptions.Timeout()
+            >>> RetryPolicy().classify(err)
+            (True, None)
+            >>> RetryPolicy().classify(err, idempotent=False)
+            (False, None)
+        """
+        safe = idempotent or self.unsafe
+
+        if isinstance(err, requests.exceptions.ConnectionError):
+            # a broken pipe means the payload is too large, so don't resend
+            return (safe and 'Broken pipe' not in '%s' % err, None)
+        elif isinstance(err, requests.exceptions.Timeout):
+            return (safe, None)
+        else:
+            status = _get_status(err)
+            return (self.retries_status(status, idempotent), status)
+
+    def retries_status(self, status, idempotent=True):
+        """Determines whether a call that failed with an HTTP status should
+        be retried.
+
+        Examples:
+            >>> RetryPolicy().retries_status(502)
+            True
+            >>> RetryPolicy().retries_status(502, idempotent=False)
+            False
+            >>> RetryPolicy().retries_status(429, idempotent=False)
+            True
+        """
+        if status not in self.statuses:
+            return False
+        else:
+            return idempotent or self.unsafe or status in THROTTLE_STATUSES
+
+    def call(self, func, args=None, kwargs=None, limiter=None, **kwds):
+        """Calls `func`, retrying on failure.
+
+        Args:
+            func (func): The function to call.
+            args (List): Positional arguments that are passed to `func`.
+            kwargs (dict): Keyword arguments that are passed to `func`.
+            limiter (obj): A :class:`RateLimiter` to acquire each attempt
+                from and to adapt with the outcome.
+
+        Kwargs:
+            on_retry (func): Called (with no arguments) before each retry.
+            idempotent (bool): `func` can safely be resent after the server
+                may have committed it, e.g., it isn't an `insert` or a
+                resource creation (default: True).
+
+        Returns:
+            obj: The result of `func`.
+
+        Examples:
+            >>> RetryPolicy().call(lambda x: x * 2, [2])
+            4
+        """
+        args, kwargs = args or [], kwargs or {}
+        on_retry = kwds.get('on_retry')
+        idempotent = kwds.get('idempotent', True)
+        attempt = 0
+
+        while True:
+            limiter.acquire() if limiter else None
+
+            try:
+                result = func(*args, **kwargs)
+            except Exception as err:
+                retryable, status = self.classify(err, idempotent)
+                retry_after = None
+                _adapt(limiter, status, retryable, _is_transport_error(err))
+
+                if not retryable or attempt >= self.retries:
+                    raise
+            else:
+                status = getattr(result, 'status_code', None)
+                retryable = self.retries_status(status, idempotent)
+
+                if retryable and attempt < self.retries:
+                    header = result.headers.get('Retry-After')
+                    retry_after = _retry_after(header)
+                    result.close()
+                    _adapt(limiter, status, retryable, retry_after=retry_after)
+                else:
+                    _adapt(limiter, status, retryable)
+                    return result
+
+            time.sleep(self.delay(attempt, retry_after))
+            _rewind(kwargs)
+            on_retry() if on_retry else None
+            attempt += 1
+
+
+def _adapt(limiter, status, retryable, transport=False, retry_after=None):
+    """Adapts a :class:`RateLimiter` to the outcome of a call. The rate is
+    lowered if the server is overloaded and raised if it answered normally,
+    but left alone on other server failures.
+    """
+    if not limiter:
+        pass
+    elif transport or status in THROTTLE_STATUSES:
+        limiter.throttle(retry_after)
+    elif not (retryable or (status or 0) >= 500):
+        limiter.success()
+
+
+def _owners(key, result):
+    """Returns the resource ids a cached `datastore_search` result belongs
+    to, i.e., the searched resource id (or alias) and the resolved one.
+
+    Examples:
+        >>> _owners('alias:abc', {'resource_id': 'rid'}) == {'alias', 'rid'}
+        True
+    """
+    owners = {str(key.split(':')[0])}
+    resolved = (result or {}).get('resource_id')
+    return owners.union([str(resolved)]) if resolved else owners
+
+
+class QueryCache(object):
+    """Read through cache of `datastore_search` results.
+
+    Entries are keyed on the normalized query, evicted least recently used
+    first once `max_bytes` is exceeded, and expire after `ttl` seconds. An
+    optional disk tier (a shelve file) keeps entries across restarts, along
+    with an index of the keys of each resource (stored under '#<id>').
+    Cached results are shared, so don't mutate them.
+
+    Attributes:
+        max_bytes (int): Max (estimated) size of the in memory entries.
+        ttl (float): Seconds an entry stays valid.
+        path (str): The disk tier file path (`None` if disabled).
+        size (int): Current (estimated) size of the in memory entries.
+        hits (int): Number of cache hits.
+        misses (int): Number of cache misses.
+    """
+
+    def __init__(self, max_bytes=CACHE_BYTES, ttl=CACHE_TTL, path=None):
+        """Initialization method.
+
+        Args:
+            max_bytes (int): Max (estimated) size of the in memory entries
+                (default: CACHE_BYTES).
+            ttl (float): Seconds an entry stays valid (default: CACHE_TTL).
+            path (str): The disk tier file path (default: None, i.e.,
+                disabled).
+
+        Returns:
+            New instance of :class:`QueryCache`
+
+        Examples:
+            >>> QueryCache().size
+            0
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.path = path
+        self.entries = OrderedDict()
+        self.keys = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.disk = shelve.open(path) if path else None
+
+    def key(self, query):
+        """Normalizes a `datastore_search` query.
+
+        Args:
+            query (dict): The `datastore_search` keyword arguments.
+
+        Returns:
+            str: The cache key.
+
+        Examples:
+            >>> cache = QueryCache()
+            >>> query = {'resource_id': 'rid', 'filters': {'a': 1, 'b': 2}}
+            >>> cache.key(query) == cache.key(dict(query, limit=None))
+            True
+        """
+        query = {k: v for k, v in query.items() if v is not None}
+        normalized = json.dumps(query, sort_keys=True, default=str)
+        digest = hashlib.sha1(normalized.encode(ENCODING)).hexdigest()
+        return str('%s:%s' % (query.get('resource_id'), digest))
+
+    def get(self, key):
+        """Gets a cached result.
 
-__title__ = 'ckanutils'
-__author__ = 'Reuben Cummings'
-__description__ = 'Miscellaneous CKAN utility library'
-__email__ = 'reubano@gmail.com'
-__license__ = 'MIT'
-__copyright__ = 'Copyright 2015 Reuben Cummings'
+        Args:
+            key (str): The cache key.
 
-CKAN_KEYS = ['hash_table', 'remote', 'api_key', 'ua', 'force', 'quiet']
-API_KEY_ENV = 'CKAN_API_KEY'
-REMOTE_ENV = 'CKAN_REMOTE_URL'
-UA_ENV = 'CKAN_USER_AGENT'
-DEF_USER_AGENT = 'ckanutils/%s' % __version__
-DEF_HASH_PACK = 'hash-table'
-DEF_HASH_RES = 'hash-table.csv'
-CHUNKSIZE_ROWS = 10 ** 3
-CHUNKSIZE_BYTES = 2 ** 20
-ENCODING = 'utf-8'
+        Returns:
+            dict: The result, `None` if missing or expired.
+
+        Examples:
+            >>> cache = QueryCache()
+            >>> key = cache.key({'resource_id': 'rid'})
+            >>> cache.set(key, {'records': []})
+            >>> cache.get(key)
+            {u'records': []}
+            >>> cache.ttl = -1
+            >>> cache.set(key, {'records': []})
+            >>> cache.get(key), cache.size
+            (None, 0)
+        """
+        now = time.time()
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry and entry[0] > now:
+                self.entries.pop(key)
+                self.entries[key] = entry
+                self.hits += 1
+                return entry[2]
+            elif entry:
+                self._remove(key)
+
+            if self.disk is not None and key in self.disk:
+                expires, result = self.disk[key]
+            else:
+                expires, result = 0, None
+
+            if expires > now:
+                self.hits += 1
+                self._add(key, result, expires)
+                return result
+            elif expires:
+                self._remove_disk(key)
+
+            self.misses += 1
+
+    def set(self, key, result):
+        """Caches a result.
+
+        Args:
+            key (str): The cache key.
+            result (dict): The `datastore_search` result.
+        """
+        expires = time.time() + self.ttl
+
+        with self.lock:
+            self._add(key, result, expires)
+
+            if self.disk is not None:
+                self.disk[key] = (expires, result)
+
+                for owner in _owners(key, result):
+                    index = str('#%s' % owner)
+                    self.disk[index] = self.disk.get(index, set()) | {key}
+
+    def _add(self, key, result, expires):
+        size = _size(result)
+
+        if key in self.entries:
+            self._remove(key)
+
+        self.entries[key] = (expires, size, result)
+        self.size += size
+
+        for owner in _owners(key, result):
+            self.keys.setdefault(owner, set()).add(key)
+
+        while self.size > self.max_bytes and self.entries:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        _, size, result = self.entries.pop(key)
+        self.size -= size
+
+        for owner in _owners(key, result):
+            keys = self.keys.get(owner, set())
+            keys.discard(key)
+
+            if not keys:
+                self.keys.pop(owner, None)
+
+    def invalidate(self, resource_id):
+        """Removes all cached results of a resource (or alias). Results
+        fetched through an alias are removed along with those of the
+        resource the alias points to.
+
+        Args:
+            resource_id (str): The datastore resource id.
+
+        Examples:
+            >>> cache = QueryCache()
+            >>> key = cache.key({'resource_id': 'alias'})
+            >>> cache.set(key, {'resource_id': 'rid', 'records': []})
+            >>> cache.invalidate('rid')
+            >>> cache.get(key)
+        """
+        resource_id = str(resource_id)
+
+        with self.lock:
+            for key in self.keys.pop(resource_id, set()).copy():
+                self._remove(key)
+
+            if self.disk is not None:
+                for key in self.disk.pop(str('#%s' % resource_id), []):
+                    self._remove_disk(key)
+
+    def _remove_disk(self, key):
+        entry = self.disk.pop(key, None)
+
+        for owner in _owners(key, entry[1]) if entry else []:
+            index = str('#%s' % owner)
+            keys = self.disk.get(index, set()) - {key}
+
+            if keys:
+                self.disk[index] = keys
+            else:
+                self.disk.pop(index, None)
+
+    def clear(self):
+        """Removes all cached results."""
+        with self.lock:
+            self.entries.clear()
+            self.keys = {}
+            self.size = 0
+
+            if self.disk is not None:
+                self.disk.clear()
+
+    def close(self):
+        """Closes the disk tier."""
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None
+
+
+class Profiler(object):
+    """Measures the time spent in each stage of a (lazy) datastore load.
+
+    Time is exclusive, i.e., the time a stage spends waiting on the stage
+    feeding it is attributed to the latter. Stages may run on several
+    threads (e.g., when prefetching), in which case their times overlap.
+
+    Memory tracing is process wide, so it is shared by concurrent loads. It
+    is only stopped by the last load if a load started it, i.e., tracing
+    started by the caller is left running.
+
+    Attributes:
+        stages (dict): Seconds spent in each stage.
+        cprofile (obj): cProfile.Profile instance (`None` if disabled).
+        tracemalloc (bool): Trace memory allocations.
+        tracing (bool): This load is tracing memory allocations.
+    """
+    tracers = 0
+    owns_tracing = False
+    tracing_lock = threading.Lock()
+
+    def __init__(self, cprofile=False, tracemalloc=False):
+        """Initialization method.
+
+        Kwargs:
+            cprofile (bool): Capture a cProfile of the load (default: False).
+            tracemalloc (bool): Trace memory allocations of the load (requires
+                the `tracemalloc` module, default: False).
+
+        Returns:
+            New instance of :class:`Profiler`
+
+        Examples:
+            >>> Profiler().stages
+            {}
+        """
+        self.stages = {}
+        self.cprofile = cProfile.Profile() if cprofile else None
+        self.tracemalloc = bool(tracemalloc and _tracemalloc)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.tracing = False
+        self.start_time = None
+        self.start_cpu = None
+
+    def start(self):
+        if self.tracemalloc:
+            self._start_tracing()
+
+        if self.cprofile:
+            self.cprofile.enable()
+
+        self.start_cpu = sum(os.times()[:2])
+        self.start_time = time.time()
+        return self
+
+    def _start_tracing(self):
+        cls = self.__class__
+
+        with cls.tracing_lock:
+            if not cls.tracers:
+                cls.owns_tracing = not _tracemalloc.is_tracing()
+
+            if cls.owns_tracing and not _tracemalloc.is_tracing():
+                _tracemalloc.start()
+
+            cls.tracers += 1
+
+        self.tracing = True
+
+        # python 3.9+
+        if hasattr(_tracemalloc, 'reset_peak'):
+            _tracemalloc.reset_peak()
+
+    def stop(self):
+        """Stops the cProfile capture and memory tracing (if enabled).
+
+        Examples:
+            >>> profiler = Profiler().start()
+            >>> profiler.stop()
+            >>> profiler.tracing
+            False
+        """
+        if self.cprofile:
+            self.cprofile.disable()
+
+        if not self.tracing:
+            return
+
+        cls, self.tracing = self.__class__, False
+
+        with cls.tracing_lock:
+            cls.tracers -= 1
+
+            if cls.owns_tracing and not cls.tracers:
+                _tracemalloc.stop()
+
+    @contextmanager
+    def section(self, stage):
+        """Attributes the time spent inside the `with` block to `stage`.
+
+        Examples:
+            >>> profiler = Profiler()
+            >>> with profiler.section('read'):
+            ...     pass
+            >>> list(profiler.stages)
+            [u'read']
+        """
+        # each thread nests its own sections
+        stack = self.local.__dict__.setdefault('stack', [])
+        frame = [time.time(), 0]
+        stack.append(frame)
+
+        try:
+            yield
+        finally:
+            elapsed = time.time() - frame[0]
+            stack.pop()
+
+            with self.lock:
+                spent = self.stages.get(stage, 0) + elapsed - frame[1]
+                self.stages[stage] = spent
+
+            if stack:
+                stack[-1][1] += elapsed
+
+    def wrap(self, iterable, stage):
+        """Attributes the time spent producing each item of `iterable` to
+        `stage`.
+
+        Examples:
+            >>> profiler = Profiler()
+            >>> list(profiler.wrap([1, 2], 'read'))
+            [1, 2]
+        """
+        iterator = iter(iterable)
+
+        while True:
+            with self.section(stage):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+
+            yield item
+
+    def report(self, rows=0, size=0):
+        """Stops profiling and returns the timing breakdown.
+
+        Args:
+            rows (int): Number of rows loaded.
+            size (int): Number of bytes loaded.
+
+        Returns:
+            dict: The report. `network` is the time blocked on the network,
+                `cpu` is the remaining wall time, and `cpu_process` is the
+                process user + system time. `max_rss` is the peak resident
+                set size over the whole process lifetime, not just the load
+                (and the only memory figure on Python 2, which lacks
+                `tracemalloc`). `peak_memory` (if tracing) is the peak traced
+                memory since the load started, or on Python < 3.9, since
+                tracing started. Concurrent loads share it.
+        """
+        elapsed = time.time() - self.start_time
+        cpu_process = sum(os.times()[:2]) - self.start_cpu
+        network = sum(self.stages.get(s, 0) for s in NETWORK_STAGES)
+
+        report = {
+            'rows': rows,
+            'bytes': size,
+            'elapsed': elapsed,
+            'rows_per_sec': rows / elapsed if elapsed else 0,
+            'bytes_per_sec': size / elapsed if elapsed else 0,
+            'stages': dict(self.stages),
+            'network': network,
+            'cpu': elapsed - network,
+            'cpu_process': cpu_process,
+        }
+
+        if getrusage:
+            # kilobytes on linux, bytes on MacOS X
+            report['max_rss'] = getrusage(RUSAGE_SELF).ru_maxrss
+
+        if self.tracing:
+            report['peak_memory'] = _tracemalloc.get_traced_memory()[1]
+
+        self.stop()
+
+        if self.cprofile:
+            stream = StringIO()
+            stats = pstats.Stats(self.cprofile, stream=stream)
+            stats.sort_stats('cumulative').print_stats(25)
+            report['cprofile'] = stream.getvalue()
+
+        return report
 
 
 class CKAN(object):
@@ -60,8 +2075,26 @@ class CKAN(object):
         force (bool): Force.
         verbose (bool): Print debug statements.
         quiet (bool): Suppress debug statements.
-        address (str): CKAN url.
+        address (str): CKAN url (the `ckan.site_url` of a local instance).
+        local (bool): Calls actions in process via `ckanapi.LocalCKAN`, i.e.,
+            no `remote` was given.
         hash_table (str): The hash table package id.
+        metrics (obj): :class:`Metrics` instance recording each action call
+            and HTTP transfer (`None` if disabled).
+        retry (obj): :class:`RetryPolicy` applied to each action call and
+            HTTP transfer (`None` if disabled).
+        limiter (obj): :class:`RateLimiter` applied to each action call and
+            HTTP transfer (`None` if disabled).
+        cache (obj): :class:`QueryCache` of `datastore_search` results
+            (`None` if disabled).
+        last_profile (dict): The :class:`Profiler` report of the last
+            profiled load.
+        last_cursor (str): The timestamp of the newest activity seen by the
+            last exhausted `changes` feed.
+        last_shadow_id (str): The datastore resource id of the table loaded
+            by the last shadow load (the one its aliases point to).
+        schemas (dict): Cached datastore table schemas keyed by resource id.
+            See `get_schema`.
         keys (List[str]):
     """
 
@@ -78,6 +2111,17 @@ class CKAN(object):
             ua (str): The user agent.
             force (bool): Force (default: True).
             quiet (bool): Suppress debug statements (default: False).
+            metrics (obj): A :class:`Metrics` instance, or True to create
+                one (default: None, i.e., disabled).
+            retry (obj): A :class:`RetryPolicy` instance, or True to create
+                one (default: None, i.e., disabled).
+            rate_limit (obj): A (possibly shared) :class:`RateLimiter`
+                instance, or the initial number of calls per second to create
+                one (default: None, i.e., disabled).
+            cache (obj): A :class:`QueryCache` instance, or True to create
+                one (default: None, i.e., disabled). The cached results of a
+                resource are invalidated by `insert_records`, `delete_table`,
+                and `create_table`.
 
         Returns:
             New instance of :class:`CKAN`
@@ -97,13 +2141,31 @@ class CKAN(object):
         self.user_agent = kwargs.get('ua', default_ua)
         self.verbose = not self.quiet
         self.hash_table = kwargs.get('hash_table', DEF_HASH_PACK)
-
+        metrics = kwargs.get('metrics')
+        self.metrics = Metrics() if metrics is True else metrics
+        retry = kwargs.get('retry')
+        self.retry = RetryPolicy() if retry is True else retry
+        limiter = kwargs.get('rate_limit')
+        is_rate = limiter and not hasattr(limiter, 'acquire')
+        self.limiter = RateLimiter(limiter) if is_rate else limiter
+        cache = kwargs.get('cache')
+        self.cache = QueryCache() if cache is True else cache
+        self.last_profile = None
+        self.last_cursor = None
+        self.last_shadow_id = None
+        self.schemas = {}
+        self.local = not remote
         ckan_kwargs = {'apikey': self.api_key, 'user_agent': self.user_agent}
-        attr = 'RemoteCKAN' if remote else 'LocalCKAN'
-        ckan = getattr(ckanapi, attr)(remote, **ckan_kwargs)
 
-        self.address = ckan.address
-        self.package_show = ckan.action.package_show
+        if remote:
+            ckan = ckanapi.RemoteCKAN(remote, **ckan_kwargs)
+            self.address = ckan.address
+        else:
+            # runs actions as the site user of the CKAN running in process
+            ckan = ckanapi.LocalCKAN()
+            self.address = _site_url()
+
+        self.package_show = self._wrap('package_show', ckan.action)
 
         try:
             self.hash_table_pack = self.package_show(id=self.hash_table)
@@ -121,23 +2183,62 @@ class CKAN(object):
             self.hash_table_id = None
 
         # shortcuts
-        self.datastore_search = ckan.action.datastore_search
-        self.datastore_create = ckan.action.datastore_create
-        self.datastore_delete = ckan.action.datastore_delete
-        self.datastore_upsert = ckan.action.datastore_upsert
-        self.datastore_search = ckan.action.datastore_search
-        self.resource_show = ckan.action.resource_show
-        self.resource_create = ckan.action.resource_create
-        self.package_create = ckan.action.package_create
-        self.package_update = ckan.action.package_update
-        self.package_privatize = ckan.action.bulk_update_private
-        self.revision_show = ckan.action.revision_show
-        self.organization_list = ckan.action.organization_list_for_user
-        self.organization_show = ckan.action.organization_show
-        self.license_list = ckan.action.license_list
-        self.group_list = ckan.action.group_list
+        for attr, action in SHORTCUTS.items():
+            setattr(self, attr, self._wrap(action, ckan.action))
+
+        if self.cache:
+            self.datastore_search = partial(self._search, self.datastore_search)
+
         self.user = ckan.action.get_site_user()
 
+    def _wrap(self, action, shortcut):
+        """Returns the ckanapi action function, wrapped by `_call` if
+        `metrics`, `retry`, or `limiter` is enabled.
+        """
+        func = getattr(shortcut, action)
+
+        if self.metrics or self.retry or self.limiter:
+            return partial(self._call, action, func)
+        else:
+            return func
+
+    def _call(self, action, func, *args, **kwargs):
+        """Calls an action (or performs an HTTP transfer), applying `metrics`,
+        `retry`, and `limiter` if enabled.
+        """
+        if self.metrics:
+            func = partial(self.metrics.measure, action, func)
+
+        if self.retry or self.limiter:
+            policy = self.retry or RetryPolicy(0)
+            metrics = self.metrics
+            on_retry = partial(metrics.retried, action) if metrics else None
+            ckwargs = {
+                'limiter': self.limiter, 'on_retry': on_retry,
+                'idempotent': _is_idempotent(action, kwargs)}
+
+            return policy.call(func, args, kwargs, **ckwargs)
+        else:
+            return func(*args, **kwargs)
+
+    def _search(self, func, **kwargs):
+        """Calls `datastore_search` through `cache`."""
+        key = self.cache.key(kwargs)
+        result = self.cache.get(key)
+
+        if result is None:
+            result = func(**kwargs)
+            self.cache.set(key, result)
+
+        return result
+
+    def _invalidate(self, *resource_ids):
+        """Invalidates the cached `datastore_search` results of resources (or
+        aliases).
+        """
+        for resource_id in resource_ids if self.cache else []:
+            self.cache.invalidate(resource_id)
+
     def create_table(self, resource_id, fields, **kwargs):
         """Creates a datastore table for an existing filestore resource.
 
@@ -174,13 +2275,20 @@ class CKAN(object):
         if self.verbose:
             print('Creating table `%s` in datastore...' % resource_id)
 
+        self._invalidate(resource_id, *(kwargs.get('aliases') or []))
+
         try:
-            return self.datastore_create(**kwargs)
+            result = self.datastore_create(**kwargs)
         except ValidationError as err:
             if err.error_dict.get('resource_id') == ['Not found: Resource']:
                 raise NotFound(err_msg)
             else:
                 raise
+        else:
+            self.schemas[resource_id] = {
+                'fields': fields, 'definition': _get_definition(kwargs)}
+
+            return result
 
     def delete_table(self, resource_id, **kwargs):
         """Deletes a datastore table.
@@ -205,8 +2313,6 @@ class CKAN(object):
             >>> CKAN(quiet=True).delete_table('rid')
             Can't delete. Table `rid` was not found in datastore.
         """
-        kwargs.setdefault('force', self.force)
-        kwargs['resource_id'] = resource_id
         init_msg = "Can't delete. Table `%s`" % resource_id
         err_msg = '%s was not found in datastore.' % init_msg
         read_msg = '%s is read only.' % init_msg
@@ -214,23 +2320,203 @@ class CKAN(object):
         if self.verbose:
             print('Deleting table `%s` from datastore...' % resource_id)
 
+        status, result = self._delete(resource_id, **kwargs)
+
+        if status == 'read only':
+            print(read_msg)
+            print("Set 'force' to True and try again.")
+        elif status == 'not found':
+            print(err_msg)
+
+        return result
+
+    def _delete(self, resource_id, **kwargs):
+        """Calls `datastore_delete`, classifying the expected failures.
+
+        Returns:
+            tuple: (status, result) where `status` is one of ['deleted',
+                'not found', 'read only'] and `result` is the original
+                filters sent if deleted, `None` otherwise.
+        """
+        kwargs.setdefault('force', self.force)
+        kwargs['resource_id'] = resource_id
+
         try:
-            result = self.datastore_delete(**kwargs)
+            status, result = 'deleted', self.datastore_delete(**kwargs)
         except NotFound:
-            print(err_msg)
-            result = None
+            status, result = 'not found', None
         except ValidationError as err:
             if 'read-only' in err.error_dict:
-                print(read_msg)
-                print("Set 'force' to True and try again.")
-                result = None
+                status, result = 'read only', None
             elif err.error_dict.get('resource_id') == ['Not found: Resource']:
-                print(err_msg)
-                result = None
+                status, result = 'not found', None
             else:
                 raise err
 
-        return result
+        if 'filters' not in kwargs:
+            self.schemas.pop(resource_id, None)
+
+        self._invalidate(resource_id)
+        return status, result
+
+    def delete_records(self, resource_id, key, values, **kwargs):
+        """Deletes the records of a datastore table whose `key` is in `values`,
+        a batch of values per request.
+
+        Args:
+            resource_id (str): The datastore resource id.
+            key (str): The field to match.
+            values (List[str]): The values to delete.
+            **kwargs: Keyword arguments that are passed to delete_tables.
+
+        Returns:
+            dict: The outcome. See `delete_tables`.
+        """
+        deletes = {resource_id: {key: list(values)}}
+        return self.delete_tables(deletes, **kwargs)[resource_id]
+
+    def delete_tables(self, deletes, workers=4, **kwargs):
+        """Deletes datastore tables (or their filtered records) concurrently.
+
+        List valued filters match any of their values. The longest one is
+        split into batches of `batchsize` values, one request per batch.
+        Failures are returned rather than raised or printed.
+
+        Args:
+            deletes (dict or List[str]): The filters to delete keyed by
+                resource id (`None` deletes the whole table), or a list of
+                resource ids to delete.
+            workers (int): Max number of tables to delete from at once
+                (default: 4).
+            **kwargs: Keyword arguments that are passed to datastore_delete.
+
+        Kwargs:
+            force (bool): Delete even if read-only.
+            batchsize (int): Max number of values per filter (default: 100).
+
+        Returns:
+            dict: The outcome of each table keyed by resource id, i.e., its
+                `status` (one of ['deleted', 'not found', 'read only',
+                'error']), the number of `requests` made, and the `error`
+                message (if any).
+        """
+        batchsize = kwargs.pop('batchsize', 100)
+        is_dict = hasattr(deletes, 'items')
+        deletes = list(deletes.items()) if is_dict else [
+            (r, None) for r in deletes]
+
+        def delete(item):
+            resource_id, filters = item
+            outcome = {'status': 'deleted', 'requests': 0}
+
+            try:
+                for batch in _batch_filters(filters, batchsize):
+                    dkwargs = dict(kwargs, filters=batch) if (
+                        batch is not None) else kwargs
+
+                    outcome['requests'] += 1
+                    status = self._delete(resource_id, **dkwargs)[0]
+
+                    if status != 'deleted':
+                        outcome['status'] = status
+                        break
+            except Exception as err:
+                outcome['status'] = 'error'
+                outcome['error'] = '%s: %s' % (type(err).__name__, err)
+
+            return resource_id, outcome
+
+        if not deletes:
+            return {}
+
+        pool = ThreadPool(min(workers, len(deletes)))
+
+        try:
+            return dict(pool.map(delete, deletes))
+        finally:
+            pool.close()
+
+    def get_schema(self, resource_id, refresh=False):
+        """Gets (and caches) the schema of a datastore table.
+
+        Args:
+            resource_id (str): The datastore resource id.
+            refresh (bool): Refetch the schema even if cached (default: False).
+
+        Returns:
+            dict: The table's `fields` (without `_id` and `_full_text`) and,
+                if the table was created by this instance, its `definition`
+                (the `aliases` and `indexes` it was created with). `None` if
+                the table was not found.
+        """
+        if refresh or resource_id not in self.schemas:
+            kwargs = {'resource_id': resource_id, 'limit': 0}
+
+            try:
+                result = self.datastore_search(**kwargs)
+            except NotFound:
+                return None
+            except ValidationError as err:
+                if err.error_dict.get('resource_id'):
+                    return None
+                else:
+                    raise err
+
+            fields = [
+                f for f in result['fields'] if f['id'] not in INTERNAL_FIELDS]
+
+            self.schemas[resource_id] = {'fields': fields}
+
+        return self.schemas[resource_id]
+
+    def reuse_table(self, resource_id, fields, **kwargs):
+        """Empties a datastore table, reusing it (and its indexes) if its
+        schema is compatible with `fields`.
+
+        The table is truncated if its fields and definition are unchanged.
+        If fields were only added, or the definition is unknown or changed,
+        the table is truncated and then altered by `create_table` (which only
+        adds missing columns and indexes). Otherwise it is recreated.
+
+        Args:
+            resource_id (str): The datastore resource id.
+            fields (List[dict]): fields/columns and their extra metadata.
+            **kwargs: Keyword arguments that are passed to create_table.
+
+        Returns:
+            str: The action taken. One of ['reused', 'altered', 'recreated'].
+        """
+        schema = self.get_schema(resource_id)
+        action = _compare_schema(schema, fields, _get_definition(kwargs))
+
+        stale = False
+
+        if action != 'recreated':
+            if self.verbose:
+                print('Reusing table `%s` in datastore...' % resource_id)
+
+            # empty filters delete all rows but keep the table
+            stale = self.delete_table(resource_id, filters={}) is None
+            action = 'recreated' if stale else action
+
+        if action == 'recreated':
+            self.delete_table(resource_id) if schema and not stale else None
+            self.create_table(resource_id, fields, **kwargs)
+        elif action == 'altered':
+            # datastore_create requires the existing fields first, in order
+            ids = [f['id'] for f in schema['fields']]
+            positions = {id_: pos for pos, id_ in enumerate(ids)}
+            fields = sorted(
+                fields, key=lambda f: positions.get(f['id'], len(ids)))
+
+            self.create_table(resource_id, fields, **kwargs)
+        else:
+            # CKAN (2.7+) unsets the resource's `datastore_active` flag when
+            # all rows are deleted, and sets it again on datastore_create
+            force = kwargs.get('force', self.force)
+            self.datastore_create(resource_id=resource_id, force=force)
+
+        return action
 
     def insert_records(self, resource_id, records, **kwargs):
         """Inserts records into a datastore table.
@@ -246,7 +2532,22 @@ class CKAN(object):
             force (bool): Create resource even if read-only.
             start (int): Row number to start from (zero indexed).
             stop (int): Row number to stop at (zero indexed).
-            chunksize (int): Number of rows to write at a time.
+            chunksize (int): Number of rows to write at a time (default:
+                0, i.e., all at once, or CHUNKSIZE_ROWS_LOCAL in `bulk` mode
+                so that a local load streams the records instead of holding
+                them all in memory).
+            bulk (bool): Pass the records to the datastore as is, i.e.,
+                without recoding them to json types. Only use with an in
+                process (local) CKAN instance (default: `local`).
+            profile (bool): Store a per stage timing breakdown in
+                `last_profile` (default: False).
+            profiler (obj): A started :class:`Profiler` to record to (used
+                by `update_datastore`).
+            prefetch (int): Number of chunks to read (and parse) ahead in a
+                background thread while the current chunk is upserted
+                (default: 0, i.e., disabled).
+            budget (obj): A :class:`RowBudget` shared with other loads that
+                caps the number of rows being upserted at once.
 
         Returns:
             int: Number of records inserted.
@@ -259,47 +2560,111 @@ class CKAN(object):
             Traceback (most recent call last):
             NotFound: Resource `rid` was not found in filestore.
         """
-        recoded = pr.json_recode(records)
+        bulk = kwargs.pop('bulk', self.local)
         chunksize = kwargs.pop('chunksize', 0)
+        chunksize = chunksize or (CHUNKSIZE_ROWS_LOCAL if bulk else chunksize)
         start = kwargs.pop('start', 0)
         stop = kwargs.pop('stop', None)
+        profiler = kwargs.pop('profiler', None)
+        profile = kwargs.pop('profile', None) and not profiler
+        read_ahead = kwargs.pop('prefetch', 0)
+        budget = kwargs.pop('budget', None)
+
+        if profile:
+            profiler = Profiler().start()
 
         kwargs.setdefault('force', self.force)
         kwargs.setdefault('method', 'insert')
         kwargs['resource_id'] = resource_id
+
+        if bulk:
+            # no http hop, so the datastore can take the typed records as is
+            recoded = records
+        elif profiler:
+            recoded = profiler.wrap(pr.json_recode(records), 'json_recode')
+        else:
+            recoded = pr.json_recode(records)
+
+        chunks = ft.chunk(recoded, chunksize, start=start, stop=stop)
+        chunks = profiler.wrap(chunks, 'chunk') if profiler else chunks
+        chunks = prefetch(chunks, read_ahead) if read_ahead else chunks
+
+        count = 0
+
+        try:
+            count = self._insert_chunks(chunks, budget, profiler, **kwargs)
+        finally:
+            # a failed chunk may still follow ones that were written
+            self._invalidate(resource_id)
+
+            if profile:
+                self.last_profile = profiler.report(max(count - 1, 0))
+
+        return count
+
+    def _insert_chunks(self, chunks, budget=None, profiler=None, **kwargs):
+        """Upserts each chunk of records.
+
+        Returns:
+            int: The number of records inserted plus 1 (`0` if a chunk was
+                too large to send).
+        """
         count = 1
 
-        for chunk in ft.chunk(recoded, chunksize, start=start, stop=stop):
+        for chunk in chunks:
             length = len(chunk)
 
             if self.verbose:
                 print(
                     'Adding records %i - %i to resource %s...' % (
-                        count, count + length - 1, resource_id))
+                        count, count + length - 1, kwargs['resource_id']))
 
             kwargs['records'] = chunk
-            err_msg = 'Resource `%s` was not found in filestore.' % resource_id
+            acquired = budget.acquire(length) if budget else 0
 
             try:
-                self.datastore_upsert(**kwargs)
-            except requests.exceptions.ConnectionError as err:
-                if 'Broken pipe' in err.message[1]:
-                    print('Chunksize too large. Try using a smaller chunksize.')
-                    return 0
-                else:
-                    raise err
-            except NotFound:
-                # Keep exception message consistent with the others
-                raise NotFound(err_msg)
-            except ValidationError as err:
-                if err.error_dict.get('resource_id') == ['Not found: Resource']:
-                    raise NotFound(err_msg)
-                else:
-                    raise err
+                sent = self._upsert(profiler, **kwargs)
+            finally:
+                budget.release(acquired) if budget else None
+
+            if not sent:
+                return 0
 
             count += length
 
-        return count
+        return count
+
+    def _upsert(self, profiler=None, **kwargs):
+        """Calls `datastore_upsert`, normalizing not found errors.
+
+        Returns:
+            bool: `False` if the records were too large to send.
+        """
+        resource_id = kwargs['resource_id']
+        err_msg = 'Resource `%s` was not found in filestore.' % resource_id
+
+        try:
+            if profiler:
+                with profiler.section('upsert'):
+                    self.datastore_upsert(**kwargs)
+            else:
+                self.datastore_upsert(**kwargs)
+        except requests.exceptions.ConnectionError as err:
+            if 'Broken pipe' in err.message[1]:
+                print('Chunksize too large. Try using a smaller chunksize.')
+                return False
+            else:
+                raise err
+        except NotFound:
+            # Keep exception message consistent with the others
+            raise NotFound(err_msg)
+        except ValidationError as err:
+            if err.error_dict.get('resource_id') == ['Not found: Resource']:
+                raise NotFound(err_msg)
+            else:
+                raise err
+
+        return True
 
     def get_hash(self, resource_id):
         """Gets the hash of a datastore table.
@@ -399,7 +2764,8 @@ class CKAN(object):
             print('Downloading url %s...' % url)
 
         headers = {'User-Agent': user_agent}
-        r = requests.get(url, stream=stream, headers=headers)
+        args = ('fetch_resource', requests.get, url)
+        r = self._call(*args, stream=stream, headers=headers)
         err_msg = 'Access to fetch resource %s was denied.' % resource_id
 
         if any('403' in h.headers.get('x-ckan-error', '') for h in r.history):
@@ -412,11 +2778,13 @@ class CKAN(object):
     def get_filestore_update_func(self, resource, **kwargs):
         """Returns the function to create or update a single resource on
         filestore. To create a resource, you must supply either `url`,
-        `filepath`, or `fileobj`.
+        `filepath`, or `fileobj`. Resources with an `id` are updated.
 
         Args:
-            resource (dict): The resource passed to resource_create.
-            **kwargs: Keyword arguments that are passed to resource_create.
+            resource (dict): The resource passed to resource_create (or
+                resource_update).
+            **kwargs: Keyword arguments that are passed to resource_create
+                (or resource_update).
 
         Kwargs:
             url (str): New file url (for file link, requires `format`).
@@ -430,9 +2798,11 @@ class CKAN(object):
 
         Returns:
             tuple: (func, args, data)
-                where func is `requests.post` if `post` option is specified,
-                `self.resource_create` otherwise. `args` and `data` should be
-                passed as *args and **kwargs respectively.
+                where func is (an optionally instrumented) `requests.post` if
+                `post` option is specified, `self.resource_update` if the
+                resource has an `id`, and `self.resource_create` otherwise.
+                `args` and `data` should be passed as *args and **kwargs
+                respectively.
 
         See also:
             ckanutils._update_filestore
@@ -454,21 +2824,25 @@ class CKAN(object):
         fileobj = kwargs.pop('fileobj', None)
         f = open(filepath, 'rb') if filepath else fileobj
         resource.update(kwargs)
+        update = bool(resource.get('id'))
+        action = 'resource_update' if update else 'resource_create'
 
         if post:
-            args = ['%s/api/action/resource_create' % self.address]
+            args = ['%s/api/action/%s' % (self.address, action)]
             hdrs = {
                 'X-CKAN-API-Key': self.api_key, 'User-Agent': self.user_agent}
 
             data = {'data': resource, 'headers': hdrs}
             data.update({'files': {'upload': f}}) if f else None
-            func = requests.post
+            # updates can safely be resent
+            name = action if update else 'resource_upload'
+            func = partial(self._call, name, requests.post)
         else:
             args = []
             resource.update({'upload': f}) if f else None
             data = {
                 k: v for k, v in resource.items() if not isinstance(v, dict)}
-            func = self.resource_create
+            func = getattr(self, action)
 
         return (func, args, data)
 
@@ -518,185 +2892,668 @@ class CKAN(object):
         err_msg = 'Resource `%s` was not found in filestore.' % resource_id
 
         try:
-            r = func(*args, **kwargs) or {'id': None}
+            r = func(*args, **kwargs) or {'id': None}
+        except NotFound:
+            pck_msg = 'Package `%s` was not found.' % package_id
+            print(err_msg if resource_id else pck_msg)
+        except ValidationError as err:
+            if err.error_dict.get('resource_id') == ['Not found: Resource']:
+                print(err_msg)
+                r = None
+            else:
+                raise err
+        except requests.exceptions.ConnectionError as err:
+            if 'Broken pipe' in err.message[1]:
+                print('File size too large. Try uploading a smaller file.')
+                r = None
+            else:
+                raise err
+        else:
+            return r
+        finally:
+            f.close() if f else None
+
+    def create_resource(self, package_id, **kwargs):
+        """Creates a single resource on filestore. You must supply either
+        `url`, `filepath`, or `fileobj`.
+
+        Args:
+            package_id (str): The filestore package id.
+            **kwargs: Keyword arguments that are passed to resource_create.
+
+        Kwargs:
+            url (str): New file url (for file link).
+            filepath (str): New file path (for file upload).
+            fileobj (obj): New file like object (for file upload).
+            post (bool): Post data using requests instead of ckanapi.
+            name (str): The resource name (defaults to the filename).
+            description (str): The resource description.
+            hash (str): The resource hash.
+
+        Returns:
+            obj: requests.Response object if `post` option is specified,
+                ckan resource object otherwise.
+
+        Raises:
+            TypeError: If neither `url`, `filepath`, nor `fileobj` are supplied.
+
+        Examples:
+            >>> ckan = CKAN(quiet=True)
+            >>> ckan.create_resource('pid')
+            Traceback (most recent call last):
+            TypeError: You must specify either a `url`, `filepath`, or `fileobj`
+            >>> ckan.create_resource('pid', url='http://example.com/file')
+            Package `pid` was not found.
+        """
+        if not any(map(kwargs.get, ['url', 'filepath', 'fileobj'])):
+            raise TypeError(
+                'You must specify either a `url`, `filepath`, or `fileobj`')
+
+        path = filter(None, map(kwargs.get, ['url', 'filepath', 'fileobj']))[0]
+
+        try:
+            if 'docs.google.com' in path:
+                def_name = path.split('gid=')[1].split('&')[0]
+            else:
+                def_name = p.basename(path)
+        except AttributeError:
+            def_name = None
+            file_format = 'csv'
+        else:
+            # copy/pasted from utils... fix later
+            if 'format=' in path:
+                file_format = path.split('format=')[1].split('&')[0]
+            else:
+                file_format = p.splitext(path)[1].lstrip('.')
+
+        kwargs.setdefault('name', def_name)
+
+        # Will get `ckan.logic.ValidationError` if url isn't set
+        kwargs.setdefault('url', 'http://example.com')
+        kwargs['format'] = file_format
+        resource = {'package_id': package_id}
+
+        if self.verbose:
+            print('Creating new resource in package %s...' % package_id)
+
+        func, args, data = self.get_filestore_update_func(resource, **kwargs)
+        return self._update_filestore(func, *args, **data)
+
+    def update_filestore(self, resource_id, **kwargs):
+        """Updates a single resource on filestore.
+
+        Args:
+            resource_id (str): The filestore resource id.
+            **kwargs: Keyword arguments that are passed to resource_create.
+
+        Kwargs:
+            url (str): New file url (for file link).
+            filepath (str): New file path (for file upload).
+            fileobj (obj): New file like object (for file upload).
+            post (bool): Post data using requests instead of ckanapi.
+            name (str): The resource name.
+            description (str): The resource description.
+            hash (str): The resource hash.
+
+        Returns:
+            obj: requests.Response object if `post` option is specified,
+                ckan resource object otherwise.
+
+        Examples:
+            >>> CKAN(quiet=True).update_filestore('rid')
+            Resource `rid` was not found in filestore.
+        """
+        err_msg = 'Resource `%s` was not found in filestore.' % resource_id
+
+        try:
+            resource = self.resource_show(id=resource_id)
+        except NotFound:
+            print(err_msg)
+            return None
+        except ValidationError as err:
+            if err.error_dict.get('resource_id') == ['Not found: Resource']:
+                raise NotFound(err_msg)
+            else:
+                raise err
+        else:
+            resource['package_id'] = self.get_package_id(resource_id)
+
+            if self.verbose:
+                print('Updating resource %s...' % resource_id)
+
+            f, args, data = self.get_filestore_update_func(resource, **kwargs)
+            return self._update_filestore(f, *args, **data)
+
+    def sync_directory(self, package_id, path, **kwargs):
+        """Uploads the new or changed files of a directory tree to a package.
+
+        Files are hashed in parallel and compared to the `hash` of the
+        package resource with the same name (the file's path relative to
+        `path`), falling back to the hash table. Only new or changed files
+        are uploaded, using a bounded pool of workers.
+
+        Args:
+            package_id (str): The filestore package id.
+            path (str): The directory to sync.
+            **kwargs: Keyword arguments.
+
+        Kwargs:
+            workers (int): Max number of concurrent uploads (default: 4).
+            hash_workers (int): Max number of files to hash concurrently
+                (default: 4).
+            algorithm (str): A hashlib algorithm name (default: 'md5').
+            post (bool): Post data using requests instead of ckanapi.
+
+        Returns:
+            dict: Summary with the keys `skipped`, `created`, `updated`, and
+                `failed` (lists of file names), and `bytes_saved` and
+                `bytes_uploaded`.
+
+        Raises:
+            NotFound: If unable to find the package.
+        """
+        files = {}
+
+        for root, dirs, filenames in os.walk(path):
+            for filename in filenames:
+                filepath = p.join(root, filename)
+                name = p.relpath(filepath, path).replace(os.sep, '/')
+                files[name] = filepath
+
+        if self.verbose:
+            print('Hashing %i files in `%s`...' % (len(files), path))
+
+        hkwargs = {
+            'algorithm': kwargs.get('algorithm', 'md5'),
+            'workers': kwargs.get('hash_workers', 4)}
+
+        hashes = _hash_files(files, **hkwargs)
+
+        package = self.package_show(id=package_id)
+        existing = {r['name']: r for r in package['resources']}
+        stored = self._get_stored_hashes(existing.values())
+        summary = {
+            'skipped': [], 'created': [], 'updated': [], 'failed': [],
+            'bytes_saved': 0, 'bytes_uploaded': 0}
+
+        jobs = []
+
+        for name in sorted(files):
+            size = p.getsize(files[name])
+            resource = existing.get(name)
+
+            if resource and stored.get(resource['id']) == hashes[name]:
+                summary['skipped'].append(name)
+                summary['bytes_saved'] += size
+            else:
+                jobs.append((name, files[name], hashes[name], size, resource))
+
+        if self.verbose:
+            print('Uploading %i files...' % len(jobs))
+
+        upload = partial(
+            self._sync_file, package['id'], post=kwargs.get('post'))
+
+        pool = ThreadPool(kwargs.get('workers', 4))
+
+        try:
+            results = pool.map(upload, jobs)
+        finally:
+            pool.close()
+
+        for (name, _, _, size, resource), r in zip(jobs, results):
+            if r is None:
+                summary['failed'].append(name)
+            else:
+                summary['updated' if resource else 'created'].append(name)
+                summary['bytes_uploaded'] += size
+
+        return summary
+
+    def _get_stored_hashes(self, resources):
+        """Gets the stored hashes of filestore resources keyed by id, from
+        their `hash` or else the hash table (fetched once).
+        """
+        stored = {r['id']: r.get('hash') for r in resources}
+        missing = [rid for rid, value in stored.items() if not value]
+
+        if missing and self.hash_table_id:
+            table = self.get_hashes()
+            stored.update((rid, table.get(rid)) for rid in missing)
+
+        return stored
+
+    def get_hashes(self):
+        """Gets all the hashes of the hash table.
+
+        Returns:
+            dict: The hashes keyed by datastore resource id (empty if the
+                hash table isn't in the datastore).
+        """
+        kwargs = {'resource_id': self.hash_table_id, 'limit': CHUNKSIZE_ROWS}
+        hashes, offset = {}, 0
+
+        while True:
+            try:
+                result = self.datastore_search(offset=offset, **kwargs)
+            except (NotFound, ValidationError):
+                if self.verbose:
+                    msg = 'Hash table `%s` was not found in datastore.'
+                    print(msg % self.hash_table_id)
+
+                return hashes
+
+            records = result['records']
+            hashes.update((r['datastore_id'], r['hash']) for r in records)
+            offset += len(records)
+
+            if not records:
+                return hashes
+
+    def _sync_file(self, package_id, job, post=None):
+        """Creates or updates the filestore resource of a single file.
+
+        Returns:
+            obj: The result (`None` if the upload failed).
+        """
+        name, filepath, file_hash, size, resource = job
+        ukwargs = {'filepath': filepath, 'hash': file_hash, 'post': post}
+
+        try:
+            if resource:
+                resource = {
+                    k: v for k, v in resource.items()
+                    if not isinstance(v, (dict, list))}
+
+                resource['package_id'] = package_id
+                res = self.get_filestore_update_func(resource, **ukwargs)
+                return self._update_filestore(res[0], *res[1], **res[2])
+            else:
+                return self.create_resource(package_id, name=name, **ukwargs)
+        except Exception as err:
+            print('Error uploading `%s`: %s' % (name, err))
+
+    def update_datastore(self, resource_id, filepath, **kwargs):
+        """Creates (or replaces) a datastore table from a local file.
+
+        Args:
+            resource_id (str): The datastore resource id.
+            filepath (str): The file to load.
+            **kwargs: Keyword arguments that are passed to the file reader.
+
+        Kwargs:
+            quiet (bool): Suppress debug statements (default: False).
+            chunksize_rows (int): Number of rows to write at a time.
+            primary_key (str): Field that represents a unique key (upserts
+                records instead of replacing the table).
+            content_type (str): The file's content type (used if `filepath`
+                has no extension). Compressed files (gz, bz2, xz, or single
+                file zip) are detected by extension or magic number and
+                decompressed as they are parsed.
+            type_cast (bool): Detect and cast field types (default: False).
+            vectorize (bool): Detect and cast field types a batch of columns
+                at a time with NumPy, if installed (default: False).
+            bulk (bool): Pass the records to the datastore without recoding
+                them. See `insert_records` (default: `local`).
+            streaming (bool): Read xlsx files row by row via `read_xlsx`
+                instead of loading the whole workbook (default: True).
+            sheet (int or str): The (zero indexed) position or the name of the
+                xlsx worksheet to read (default: 0).
+            aliases (List[str]): name(s) for read only alias(es) of the
+                resource.
+            indexes (List[str]): index(es) on table.
+            reuse (bool): Truncate (and if needed alter) the existing table
+                instead of recreating it if its schema is compatible. See
+                `reuse_table` (default: True).
+            shadow (bool): Load into a new table and then repoint `aliases`
+                to it instead of replacing the table in place (ignored if
+                `primary_key` is set). The new table's id is stored in
+                `last_shadow_id`. See `shadow_load` (default: False).
+            defer_indexes (bool): Build the shadow table's indexes after
+                loading it (default: True).
+            keep (bool): Keep the tables of previous shadow loads (default:
+                False).
+            drop (bool): Delete the resource's own table after a shadow load
+                (default: False).
+            prefetch (int): Number of chunks to parse ahead while upserting.
+                See `insert_records` (default: 0).
+            budget (obj): A shared :class:`RowBudget`. See `insert_records`.
+            profile (bool): Store a per stage timing breakdown in
+                `last_profile` (default: False).
+            cprofile (bool): Include a cProfile capture in the profile
+                (default: False).
+            tracemalloc (bool): Include the peak traced memory in the profile
+                (default: False).
+
+        Returns:
+            int: Number of records inserted (plus one), `False` if no reader
+                is available for the file type.
+        """
+        verbose = not kwargs.get('quiet')
+        primary_key = kwargs.get('primary_key')
+        shadow = kwargs.get('shadow') and not primary_key
+        create_keys = ['aliases', 'primary_key', 'indexes']
+        records = self._read(filepath, **kwargs)
+        profiler, count = None, 0
+
+        if records is None:
+            return False
+
+        if any(map(kwargs.get, ['profile', 'cprofile', 'tracemalloc'])):
+            pkwargs = {k: kwargs.get(k) for k in ['cprofile', 'tracemalloc']}
+            profiler = Profiler(**pkwargs).start()
+
+        try:
+            records = profiler.wrap(records, 'read') if profiler else records
+            types, casted_records = self._get_types(records, profiler, **kwargs)
+
+            if verbose:
+                print('Parsed types:')
+                pprint(types)
+
+            create_kwargs = {
+                k: v for k, v in kwargs.items() if k in create_keys}
+
+            insert_kwargs = {
+                'chunksize': kwargs.get('chunksize_rows'),
+                'method': 'upsert' if primary_key else 'insert',
+                'profiler': profiler, 'bulk': kwargs.get('bulk', self.local),
+                'prefetch': kwargs.get('prefetch'),
+                'budget': kwargs.get('budget')}
+
+            if shadow:
+                create_kwargs.update(insert_kwargs)
+                create_kwargs['defer_indexes'] = kwargs.get('defer_indexes')
+                create_kwargs['keep'] = kwargs.get('keep')
+                create_kwargs['drop'] = kwargs.get('drop')
+                args = [resource_id, types, casted_records]
+                count = self.shadow_load(*args, **create_kwargs)[1]
+            else:
+                reuse = kwargs.get('reuse', True)
+                args = [resource_id, types, reuse]
+                self._prepare_table(*args, **create_kwargs)
+                args = [resource_id, casted_records]
+                count = self.insert_records(*args, **insert_kwargs)
+        finally:
+            if profiler:
+                size = p.getsize(filepath) if p.isfile(filepath) else 0
+                rows = max(count - 1, 0)
+                self.last_profile = profiler.report(rows, size)
+
+        return count
+
+    def _read(self, filepath, **kwargs):
+        """Opens a (possibly compressed) file with the reader for its type.
+
+        Returns:
+            iter: The records (`None` if no reader is available).
+        """
+        compression = get_compression(filepath)
+
+        try:
+            f, filename = open_compressed(filepath, compression) if (
+                compression) else (None, filepath)
+        except TypeError as err:
+            print('Error: %s' % err)
+            return None
+
+        try:
+            extension = p.splitext(filename)[1].split('.')[1]
+        except (IndexError, AttributeError):
+            # no file extension given, e.g., a tempfile
+            extension = cv.ctype2ext(kwargs.get('content_type'))
+
+        streaming = kwargs.get('streaming', True) and not f
+
+        try:
+            if extension == 'xlsx' and streaming:
+                reader = read_xlsx
+            else:
+                reader = io.get_reader(extension)
+        except TypeError:
+            print('Error: plugin for extension `%s` not found!' % extension)
+            f.close() if f else None
+            return None
+
+        if f:
+            # parse the decompressed stream incrementally
+            return _closing(reader(f, **kwargs), f)
+        else:
+            return reader(filepath, **kwargs)
+
+    def _get_types(self, records, profiler=None, **kwargs):
+        """Detects the field types of records and casts them if `type_cast`
+        is set, otherwise treats all fields as text.
+
+        Returns:
+            tuple: (types, records)
+        """
+        first = records.next()
+        records = it.chain([first], records)
+
+        if not kwargs.get('type_cast'):
+            types = [{'id': key, 'type': 'text'} for key in first.keys()]
+            return types, records
+
+        if kwargs.get('vectorize'):
+            detect, cast = vectorized_detect_types, vectorized_type_cast
+        else:
+            detect, cast = pr.detect_types, pr.type_cast
+
+        if profiler:
+            with profiler.section('detect_types'):
+                records, results = detect(records)
+
+            records = profiler.wrap(records, 'detect_types')
+            casted = cast(records, results['types'])
+            casted = profiler.wrap(casted, 'type_cast')
+        else:
+            records, results = detect(records)
+            casted = cast(records, results['types'])
+
+        return results['types'], casted
+
+    def _prepare_table(self, resource_id, fields, reuse=True, **kwargs):
+        """Creates, reuses, or replaces the datastore table of a load."""
+        if kwargs.get('primary_key'):
+            self.create_table(resource_id, fields, **kwargs)
+        elif reuse:
+            self.reuse_table(resource_id, fields, **kwargs)
+        else:
+            self.delete_table(resource_id)
+            self.create_table(resource_id, fields, **kwargs)
+
+    def get_alias_owner(self, alias):
+        """Gets the datastore resource id an alias points to.
+
+        Args:
+            alias (str): The alias name.
+
+        Returns:
+            str: The resource id (`None` if the alias doesn't exist).
+        """
+        try:
+            result = self.datastore_search(resource_id=alias, limit=0)
         except NotFound:
-            pck_msg = 'Package `%s` was not found.' % package_id
-            print(err_msg if resource_id else pck_msg)
+            return None
         except ValidationError as err:
-            if err.error_dict.get('resource_id') == ['Not found: Resource']:
-                print(err_msg)
-                r = None
-            else:
-                raise err
-        except requests.exceptions.ConnectionError as err:
-            if 'Broken pipe' in err.message[1]:
-                print('File size too large. Try uploading a smaller file.')
-                r = None
+            if err.error_dict.get('resource_id'):
+                return None
             else:
                 raise err
-        else:
-            return r
-        finally:
-            f.close() if f else None
 
-    def create_resource(self, package_id, **kwargs):
-        """Creates a single resource on filestore. You must supply either
-        `url`, `filepath`, or `fileobj`.
+        # datastore_search resolves aliases to the resource they point to
+        owner = result.get('resource_id')
+        return owner if owner != alias else None
 
-        Args:
-            package_id (str): The filestore package id.
-            **kwargs: Keyword arguments that are passed to resource_create.
+    def _get_alias_owners(self, aliases, exclude=None):
+        """Groups aliases by the datastore resource id they point to."""
+        owners = {}
 
-        Kwargs:
-            url (str): New file url (for file link).
-            filepath (str): New file path (for file upload).
-            fileobj (obj): New file like object (for file upload).
-            post (bool): Post data using requests instead of ckanapi.
-            name (str): The resource name (defaults to the filename).
-            description (str): The resource description.
-            hash (str): The resource hash.
+        for alias in aliases:
+            owner = self.get_alias_owner(alias)
 
-        Returns:
-            obj: requests.Response object if `post` option is specified,
-                ckan resource object otherwise.
+            if owner and owner != exclude:
+                owners.setdefault(owner, []).append(alias)
 
-        Raises:
-            TypeError: If neither `url`, `filepath`, nor `fileobj` are supplied.
+        return owners
 
-        Examples:
-            >>> ckan = CKAN(quiet=True)
-            >>> ckan.create_resource('pid')
-            Traceback (most recent call last):
-            TypeError: You must specify either a `url`, `filepath`, or `fileobj`
-            >>> ckan.create_resource('pid', url='http://example.com/file')
-            Package `pid` was not found.
+    def swap_aliases(self, old_id, new_id, aliases, keep=False, drop=False):
+        """Repoints datastore aliases to a new table.
+
+        The aliases are dropped from the table(s) they currently point to
+        (which may be a previous shadow table rather than `old_id`) and then
+        created on the new one. CKAN has no atomic alias swap, so this takes
+        two consecutive calls. If creating them fails, they are restored.
+        Unless `keep` is set, replaced previous shadow tables are then
+        deleted along with their filestore resources. The table of `old_id`
+        is left in place (readers of the resource itself still use it)
+        unless `drop` is set.
+
+        Args:
+            old_id (str): The datastore resource id being replaced.
+            new_id (str): The datastore resource id to point them to.
+            aliases (List[str]): name(s) of the read only alias(es).
+            keep (bool): Keep the replaced shadow tables (default: False).
+            drop (bool): Delete the table of `old_id` (default: False).
+
+        Returns:
+            str: `new_id`
         """
-        if not any(map(kwargs.get, ['url', 'filepath', 'fileobj'])):
-            raise TypeError(
-                'You must specify either a `url`, `filepath`, or `fileobj`')
+        owners = self._get_alias_owners(aliases, exclude=new_id)
 
-        path = filter(None, map(kwargs.get, ['url', 'filepath', 'fileobj']))[0]
+        if self.verbose:
+            msg = 'Repointing aliases %s from table(s) %s to `%s`...'
+            tables = ', '.join('`%s`' % o for o in owners or [old_id])
+            print(msg % (', '.join(aliases), tables, new_id))
+
+        self._invalidate(*aliases)
+        kwargs = {'force': self.force}
+
+        for owner in owners:
+            # an empty list drops any existing aliases
+            self.datastore_create(resource_id=owner, aliases=[], **kwargs)
 
         try:
-            if 'docs.google.com' in path:
-                def_name = path.split('gid=')[1].split('&')[0]
-            else:
-                def_name = p.basename(path)
-        except AttributeError:
-            def_name = None
-            file_format = 'csv'
-        else:
-            # copy/pasted from utils... fix later
-            if 'format=' in path:
-                file_format = path.split('format=')[1].split('&')[0]
-            else:
-                file_format = p.splitext(path)[1].lstrip('.')
+            self.datastore_create(resource_id=new_id, aliases=aliases, **kwargs)
+        except Exception:
+            for owner, owned in owners.items():
+                kwargs.update(resource_id=owner, aliases=owned)
+                self.datastore_create(**kwargs)
 
-        kwargs.setdefault('name', def_name)
+            raise
 
-        # Will get `ckan.logic.ValidationError` if url isn't set
-        kwargs.setdefault('url', 'http://example.com')
-        kwargs['format'] = file_format
-        resource = {'package_id': package_id}
+        replaced = set(owners).union([old_id]).difference([new_id])
 
-        if self.verbose:
-            print('Creating new resource in package %s...' % package_id)
+        for resource_id in replaced:
+            self.schemas.pop(resource_id, None)
 
-        func, args, data = self.get_filestore_update_func(resource, **kwargs)
-        return self._update_filestore(func, *args, **data)
+            if resource_id == old_id:
+                self._delete(resource_id) if drop else None
+            elif not keep:
+                self._delete_resource(resource_id)
 
-    def update_filestore(self, resource_id, **kwargs):
-        """Updates a single resource on filestore.
+        self.schemas.pop(new_id, None)
+        return new_id
+
+    def _delete_resource(self, resource_id):
+        """Deletes a (shadow) filestore resource and its datastore table."""
+        self._delete(resource_id)
+
+        try:
+            self.resource_delete(id=resource_id)
+        except NotFound:
+            pass
+
+    def shadow_load(self, resource_id, fields, records, **kwargs):
+        """Loads records into a new (shadow) datastore table in the same
+        package, and then repoints `aliases` to it. Readers of the aliases
+        keep seeing the old table until the load completes. If the load
+        fails, the shadow table is deleted and the old table is untouched.
+        The table replaced by a previous shadow load is deleted along with
+        its filestore resource, so repeated loads don't pile up resources.
+        The resource's own table is kept unless `drop` is set.
 
         Args:
-            resource_id (str): The filestore resource id.
-            **kwargs: Keyword arguments that are passed to resource_create.
+            resource_id (str): The datastore resource id being replaced.
+            fields (List[dict]): fields/columns and their extra metadata.
+            records (List[dict]): The records to insert.
+            **kwargs: Keyword arguments that are passed to insert_records.
 
         Kwargs:
-            url (str): New file url (for file link).
-            filepath (str): New file path (for file upload).
-            fileobj (obj): New file like object (for file upload).
-            post (bool): Post data using requests instead of ckanapi.
-            name (str): The resource name.
-            description (str): The resource description.
-            hash (str): The resource hash.
+            aliases (List[str]): name(s) for read only alias(es) of the
+                resource (required).
+            primary_key (List[str]): field(s) that represent a unique key.
+            indexes (List[str]): index(es) on table.
+            defer_indexes (bool): Build the indexes after loading the table
+                (default: True).
+            keep (bool): Keep the tables of previous shadow loads (default:
+                False).
+            drop (bool): Delete the resource's own table once the aliases
+                point to the shadow table (default: False).
 
         Returns:
-            obj: requests.Response object if `post` option is specified,
-                ckan resource object otherwise.
+            tuple: (shadow_id, count) where `shadow_id` is the new datastore
+                resource id (also stored in `last_shadow_id`) and `count` is
+                the return value of `insert_records`.
+
+        Raises:
+            TypeError: If `aliases` isn't supplied.
+            NotFound: If unable to find the resource.
 
         Examples:
-            >>> CKAN(quiet=True).update_filestore('rid')
-            Resource `rid` was not found in filestore.
+            >>> CKAN(quiet=True).shadow_load('rid', [], [])
+            Traceback (most recent call last):
+            TypeError: You must specify `aliases` for a shadow load
         """
+        aliases = kwargs.pop('aliases', None)
+        swap_kwargs = {k: kwargs.pop(k, False) for k in ['keep', 'drop']}
+        defer = kwargs.pop('defer_indexes', None) is not False
+        index_keys = ['primary_key', 'indexes']
+        index_kwargs = {k: kwargs.pop(k) for k in index_keys if k in kwargs}
         err_msg = 'Resource `%s` was not found in filestore.' % resource_id
 
+        if not aliases:
+            raise TypeError('You must specify `aliases` for a shadow load')
+
         try:
             resource = self.resource_show(id=resource_id)
         except NotFound:
-            print(err_msg)
-            return None
+            raise NotFound(err_msg)
         except ValidationError as err:
             if err.error_dict.get('resource_id') == ['Not found: Resource']:
                 raise NotFound(err_msg)
             else:
                 raise err
-        else:
-            resource['package_id'] = self.get_package_id(resource_id)
 
-            if self.verbose:
-                print('Updating resource %s...' % resource_id)
+        shadow = {
+            'package_id': resource['package_id'],
+            'name': resource.get('name') or resource_id,
+            'format': resource.get('format')}
 
-            f, args, data = self.get_filestore_update_func(resource, **kwargs)
-            return self._update_filestore(f, *args, **data)
+        create_kwargs = {'resource': shadow, 'fields': fields}
+        create_kwargs.update({} if defer else index_kwargs)
+        create_kwargs['force'] = self.force
 
-    def update_datastore(self, resource_id, filepath, **kwargs):
-        verbose = not kwargs.get('quiet')
-        chunk_rows = kwargs.get('chunksize_rows')
-        primary_key = kwargs.get('primary_key')
-        content_type = kwargs.get('content_type')
-        type_cast = kwargs.get('type_cast')
-        method = 'upsert' if primary_key else 'insert'
-        keys = ['aliases', 'primary_key', 'indexes']
+        if self.verbose:
+            print('Creating shadow table for `%s`...' % resource_id)
 
-        try:
-            extension = p.splitext(filepath)[1].split('.')[1]
-        except (IndexError, AttributeError):
-            # no file extension given, e.g., a tempfile
-            extension = cv.ctype2ext(content_type)
+        shadow_id = self.datastore_create(**create_kwargs)['resource_id']
 
         try:
-            reader = io.get_reader(extension)
-        except TypeError:
-            print('Error: plugin for extension `%s` not found!' % extension)
-            return False
-        else:
-            records = reader(filepath, **kwargs)
-            first = records.next()
-            keys = first.keys()
-            records = it.chain([first], records)
-
-            if type_cast:
-                records, results = pr.detect_types(records)
-                types = results['types']
-                casted_records = pr.type_cast(records, types)
-            else:
-                types = [{'id': key, 'type': 'text'} for key in keys]
-                casted_records = records
-
-            if verbose:
-                print('Parsed types:')
-                pprint(types)
+            count = self.insert_records(shadow_id, records, **kwargs)
 
-            create_kwargs = {k: v for k, v in kwargs.items() if k in keys}
+            if defer and any(index_kwargs.values()):
+                # build indexes once instead of maintaining them per insert
+                self.create_table(shadow_id, fields, **index_kwargs)
 
-            if not primary_key:
-                self.delete_table(resource_id)
+            self.swap_aliases(resource_id, shadow_id, aliases, **swap_kwargs)
+        except Exception:
+            self._delete_resource(shadow_id)
+            raise
 
-            insert_kwargs = {'chunksize': chunk_rows, 'method': method}
-            self.create_table(resource_id, types, **create_kwargs)
-            args = [resource_id, casted_records]
-            return self.insert_records(*args, **insert_kwargs)
+        self.last_shadow_id = shadow_id
+        return shadow_id, count
 
     def find_ids(self, packages, **kwargs):
         default = {'rid': '', 'pname': ''}
@@ -821,3 +3678,489 @@ class CKAN(object):
 
             for resource in sorted(resources, **skwargs):
                 yield {'rid': resource['id'], 'pname': package['name']}
+
+    def _activities(self, since=None, pagesize=100):
+        """Yields the activities newer than `since`, newest first. Pages
+        until a page is empty rather than short since portals may cap
+        `limit` below `pagesize`.
+        """
+        offset = 0
+
+        while True:
+            activities = self.activity_list(offset=offset, limit=pagesize)
+
+            for activity in activities:
+                if since and activity['timestamp'] <= since:
+                    return
+
+                yield activity
+
+            if not activities:
+                return
+
+            offset += len(activities)
+
+    def changes(self, since=None, **kwargs):
+        """Yields the resources changed since a cursor, newest first, by
+        polling the activity stream instead of walking the whole catalog.
+
+        A resource is considered changed if its package was created or
+        deleted, or if it was modified in the activity's revision. Each
+        resource is only yielded once (for its latest change). Packages
+        changed without touching any resource are yielded with a `rid` of
+        `None`.
+
+        Args:
+            since (str): Only yield changes newer than this timestamp, e.g.,
+                the `last_cursor` of a previous run (default: None, i.e.,
+                read from `cursor_path` if it exists, else all changes).
+
+        Kwargs:
+            cursor_path (str): File to read the cursor from (if `since` isn't
+                given) and to save the new cursor to once the feed is
+                exhausted.
+            pagesize (int): Number of activities to fetch at a time (default:
+                100).
+
+        Yields:
+            dict: The changed resource's id (`rid`), its package's name
+                (`pname`) and id (`pid`), the kind of `change` (one of ['new',
+                'changed', 'deleted']), and the activity `timestamp`.
+        """
+        cursor_path = kwargs.get('cursor_path')
+        pagesize = kwargs.get('pagesize', 100)
+
+        if since is None and cursor_path and p.exists(cursor_path):
+            with open(cursor_path) as f:
+                since = f.read().strip() or None
+
+        seen, packages, deleted = set(), set(), set()
+        cursor = since
+
+        for activity in self._activities(since, pagesize):
+            timestamp = activity['timestamp']
+            cursor = max(cursor or timestamp, timestamp)
+            change = activity['activity_type'].split(' ')[0]
+            package = activity.get('data', {}).get('package', {})
+            pid = package.get('id', activity['object_id'])
+
+            if pid in deleted:
+                # older changes of a since deleted package don't matter
+                continue
+            elif change == 'deleted':
+                deleted.add(pid)
+
+            item = {
+                'pname': package.get('name'), 'pid': pid, 'change': change,
+                'timestamp': timestamp}
+
+            revision_id = activity.get('revision_id')
+            resources = _changed_resources(package, change, revision_id)
+
+            for resource in resources:
+                if resource['id'] not in seen:
+                    seen.add(resource['id'])
+                    item['rid'] = resource['id']
+                    yield dict(item)
+
+            if not (resources or pid in packages):
+                item['rid'] = None
+                yield item
+
+            packages.add(pid)
+
+        self.last_cursor = cursor
+
+        if cursor_path and cursor:
+            with open(cursor_path, 'w') as f:
+                f.write(cursor)
+
+
+def _changed_resources(package, change, revision_id=None):
+    """Gets the resources of a package activity's revision (all of them if
+    the package was created or deleted).
+
+    Examples:
+        >>> package = {'resources': [
+        ...     {'id': 'r1', 'revision_id': 'a'},
+        ...     {'id': 'r2', 'revision_id': 'b'}]}
+        >>> [r['id'] for r in _changed_resources(package, 'changed', 'b')]
+        [u'r2']
+        >>> [r['id'] for r in _changed_resources(package, 'new', 'b')]
+        [u'r1', u'r2']
+    """
+    resources = package.get('resources', [])
+
+    if change == 'changed':
+        resources = [
+            r for r in resources if r.get('revision_id') == revision_id]
+
+    return resources
+
+
+def replicate_table(src_ckan, src_id, dst_ckan, dst_id, **kwargs):
+    """Copies a datastore table from one CKAN instance to another.
+
+    Pages are fetched from the source in a background thread while the
+    previous pages are upserted to the destination, with at most `buffer`
+    pages waiting in between. Pages are read in `_id` order using keyset
+    paging via `datastore_search_sql`, falling back to offset paging if the
+    source doesn't allow sql queries (which assumes `_id`s are contiguous
+    in incremental mode). Other errors are raised, so pass a `retry` policy
+    to the source :class:`CKAN` to ride out transient ones.
+
+    Args:
+        src_ckan (obj): The source :class:`CKAN` instance.
+        src_id (str): The source datastore resource id.
+        dst_ckan (obj): The destination :class:`CKAN` instance.
+        dst_id (str): The destination datastore resource id.
+        **kwargs: Keyword arguments that are passed to create_table.
+
+    Kwargs:
+        since (int): Only copy records whose `_id` is greater than this
+            watermark, i.e., the `watermark` of a previous run, and don't
+            recreate the destination table (default: None).
+        pagesize (int): Number of rows to fetch at a time (default:
+            CHUNKSIZE_ROWS).
+        buffer (int): Max number of fetched pages waiting to be upserted
+            (default: 4).
+        sql (bool): Use keyset paging via `datastore_search_sql`
+            (default: True).
+        primary_key (List[str]): field(s) that represent a unique key (pages
+            are upserted instead of inserted).
+
+    Returns:
+        dict: The number of `rows` copied and the `watermark` (the last
+            copied source `_id`) to pass as `since` on the next run.
+    """
+    since = kwargs.pop('since', None)
+    pagesize = kwargs.pop('pagesize', CHUNKSIZE_ROWS)
+    buffer_size = kwargs.pop('buffer', 4)
+    use_sql = kwargs.pop('sql', True)
+    method = 'upsert' if kwargs.get('primary_key') else 'insert'
+    fields = src_ckan.datastore_search(resource_id=src_id, limit=0)['fields']
+    fields = [f for f in fields if f['id'] not in INTERNAL_FIELDS]
+
+    if since is None:
+        dst_ckan.delete_table(dst_id)
+
+    dst_ckan.create_table(dst_id, fields, **kwargs)
+
+    pages = _fetch_pages(src_ckan, src_id, since, pagesize, use_sql)
+    rows, watermark = 0, since
+
+    for records in prefetch(pages, buffer_size):
+        watermark = records[-1]['_id']
+        records = [
+            {k: v for k, v in r.items() if k not in INTERNAL_FIELDS}
+            for r in records]
+
+        ikwargs = {'method': method, 'chunksize': pagesize}
+        dst_ckan.insert_records(dst_id, records, **ikwargs)
+        rows += len(records)
+
+    return {'rows': rows, 'watermark': watermark}
+
+
+def _fetch_pages(ckan, resource_id, since=None, pagesize=CHUNKSIZE_ROWS,
+                 sql=True):
+    """Fetches the records of a datastore table a page at a time in `_id`
+    order, using keyset paging via `datastore_search_sql` if allowed.
+
+    Yields:
+        List[dict]: The records of each page.
+    """
+    query = 'SELECT * FROM "%s" WHERE _id > %%i ORDER BY _id LIMIT %i'
+    query %= (resource_id, pagesize)
+    search = partial(
+        ckan.datastore_search, resource_id=resource_id, sort='_id',
+        limit=pagesize)
+
+    watermark, keyset = since or 0, sql
+
+    # the paging mode is decided once, since a page refetched by offset
+    # after a keyset page would skip rows if `_id`s have gaps
+    if keyset:
+        try:
+            result = ckan.datastore_search_sql(sql=query % watermark)
+        except CKANAPIError as err:
+            if not _sql_disabled(err):
+                raise
+
+            keyset = False
+
+    if not keyset:
+        result = search(offset=watermark)
+
+    while result['records']:
+        records = result['records']
+        yield records
+
+        if keyset:
+            watermark = records[-1]['_id']
+            result = ckan.datastore_search_sql(sql=query % watermark)
+        else:
+            watermark += len(records)
+            result = search(offset=watermark)
+
+
+def _sql_disabled(err):
+    """Determines whether a `datastore_search_sql` error means sql queries
+    aren't allowed (as opposed to a failed query).
+
+    Examples:
+        >>> _sql_disabled(NotAuthorized('Access denied'))
+        True
+        >>> _sql_disabled(CKANAPIError('Action name not known: x'))
+        True
+        >>> _sql_disabled(CKANAPIError('Service Unavailable'))
+        False
+    """
+    disabled = 'Action name not known' in '%s' % err
+    return isinstance(err, NotAuthorized) or disabled
+
+
+class IngestScheduler(object):
+    """Loads many files into datastore tables concurrently.
+
+    Jobs run on a pool of `workers` threads, largest (or most urgent) first,
+    while capping the number of jobs (i.e., open connections) per CKAN host
+    and the number of rows in flight per host and across all jobs. A worker
+    skips jobs whose host is at its limit, so a slow portal doesn't hold up
+    the others.
+
+    Attributes:
+        ckan (obj): The default :class:`CKAN` instance.
+        workers (int): Max number of jobs running at once.
+        host_limit (int): Default max number of jobs running at once per host.
+        host_limits (dict): Max number of jobs running at once keyed by host.
+        budget (obj): The :class:`RowBudget` shared by all jobs (`None` if
+            unlimited).
+        host_rows (int): Default max number of rows in flight per host.
+        host_row_limits (dict): Max number of rows in flight keyed by host.
+        budgets (dict): The per host :class:`RowBudget` instances.
+        prefetch (int): Number of chunks each job parses ahead while
+            upserting.
+        jobs (List[dict]): The pending jobs.
+    """
+
+    def __init__(self, ckan=None, workers=4, **kwargs):
+        """Initialization method.
+
+        Args:
+            ckan (obj): The default :class:`CKAN` instance (default: None).
+            workers (int): Max number of jobs running at once (default: 4).
+
+        Kwargs:
+            host_limit (int): Default max number of jobs running at once per
+                host (default: 2).
+            host_limits (dict): Max number of jobs running at once keyed by
+                host, e.g., {'demo.ckan.org': 1} (default: {}).
+            max_rows (int): Max number of rows in flight across all jobs
+                (default: None, i.e., unlimited).
+            host_rows (int): Default max number of rows in flight per host
+                (default: None, i.e., unlimited).
+            host_row_limits (dict): Max number of rows in flight keyed by
+                host, e.g., {'demo.ckan.org': 10000} (default: {}).
+            prefetch (int): Number of chunks each job parses ahead while
+                upserting (default: 1).
+
+        Returns:
+            New instance of :class:`IngestScheduler`
+
+        Examples:
+            >>> IngestScheduler(workers=2).workers
+            2
+        """
+        self.ckan = ckan
+        self.workers = workers
+        self.host_limit = kwargs.get('host_limit', 2)
+        self.host_limits = kwargs.get('host_limits', {})
+        max_rows = kwargs.get('max_rows')
+        self.budget = RowBudget(max_rows) if max_rows else None
+        self.host_rows = kwargs.get('host_rows')
+        self.host_row_limits = kwargs.get('host_row_limits', {})
+        self.budgets = {}
+        self.prefetch = kwargs.get('prefetch', 1)
+        self.jobs = []
+
+    def add(self, resource_id, filepath, ckan=None, **kwargs):
+        """Adds a job.
+
+        Args:
+            resource_id (str): The datastore resource id.
+            filepath (str): The file to load.
+            ckan (obj): The :class:`CKAN` instance to load into (default:
+                the scheduler's `ckan`).
+            **kwargs: Keyword arguments that are passed to update_datastore.
+
+        Kwargs:
+            deadline (float): Unix timestamp the job should be done by. Jobs
+                with a deadline run first, earliest first (default: None).
+
+        Raises:
+            TypeError: If no CKAN instance is given.
+
+        Examples:
+            >>> scheduler = IngestScheduler()
+            >>> scheduler.add('rid', 'file.csv')
+            Traceback (most recent call last):
+            TypeError: No CKAN instance given for resource `rid`.
+        """
+        ckan = ckan or self.ckan
+
+        if not ckan:
+            raise TypeError(
+                'No CKAN instance given for resource `%s`.' % resource_id)
+
+        try:
+            size = p.getsize(filepath)
+        except (OSError, TypeError):
+            size = 0
+
+        host = urlparse(ckan.address).netloc or ckan.address
+        self.jobs.append({
+            'resource_id': resource_id, 'filepath': filepath, 'ckan': ckan,
+            'host': host, 'deadline': kwargs.pop('deadline', None),
+            'size': size, 'kwargs': kwargs})
+
+    def _limit(self, host):
+        return self.host_limits.get(host, self.host_limit)
+
+    def _budget(self, host):
+        """Gets the :class:`RowBudget` of a host (`None` if unlimited)."""
+        if host not in self.budgets:
+            max_rows = self.host_row_limits.get(host, self.host_rows)
+            self.budgets[host] = (
+                RowBudget(max_rows, self.budget) if max_rows else self.budget)
+
+        return self.budgets[host]
+
+    def _load(self, job):
+        kwargs = dict(job['kwargs'])
+        kwargs.setdefault('prefetch', self.prefetch)
+        kwargs['budget'] = self.budgets.get(job['host'], self.budget)
+        start = time.time()
+        result = {
+            'resource_id': job['resource_id'], 'filepath': job['filepath'],
+            'host': job['host'], 'rows': 0}
+
+        try:
+            args = (job['resource_id'], job['filepath'])
+            count = job['ckan'].update_datastore(*args, **kwargs)
+        except Exception as err:
+            result['error'] = '%s: %s' % (type(err).__name__, err)
+        else:
+            if count:
+                result['rows'] = count - 1
+            else:
+                result['error'] = 'No reader for `%s`.' % job['filepath']
+
+        result['elapsed'] = time.time() - start
+        return result
+
+    def run(self, jobs=None):
+        """Runs the pending jobs.
+
+        Args:
+            jobs (List[tuple]): Additional (resource_id, filepath) jobs for the
+                default CKAN instance (default: None).
+
+        Returns:
+            dict: An aggregate report with the number of `jobs`, `rows`,
+                `elapsed` seconds, `rows_per_sec`, the per job `results`, a
+                per host summary (`hosts`), and the `failed` jobs.
+
+        Examples:
+            >>> IngestScheduler().run()['jobs']
+            0
+        """
+        for resource_id, filepath in jobs or []:
+            self.add(resource_id, filepath)
+
+        pending, self.jobs = sorted(self.jobs, key=_priority), []
+        start = time.time()
+
+        # create the host budgets before any job can use them
+        for job in pending:
+            self._budget(job['host'])
+
+        results = self._run_jobs(pending) if pending else []
+        return _summarize(results, time.time() - start)
+
+    def _run_jobs(self, pending):
+        """Runs jobs on the worker pool, respecting the host limits."""
+        active = {job['host']: 0 for job in pending}
+        cond = threading.Condition()
+        results = []
+
+        def next_job():
+            with cond:
+                while pending:
+                    for job in pending:
+                        if active[job['host']] < self._limit(job['host']):
+                            pending.remove(job)
+                            active[job['host']] += 1
+                            return job
+
+                    cond.wait()
+
+        def work(_):
+            job = next_job()
+
+            while job:
+                try:
+                    results.append(self._load(job))
+                finally:
+                    with cond:
+                        active[job['host']] -= 1
+                        cond.notify_all()
+
+                job = next_job()
+
+        size = min(self.workers, len(pending))
+        pool = ThreadPool(size)
+
+        try:
+            pool.map(work, range(size))
+        finally:
+            pool.close()
+
+        return results
+
+
+def _priority(job):
+    """Sorts jobs earliest deadline first, then largest first so that small
+    jobs fill in the gaps at the end.
+
+    Examples:
+        >>> jobs = [
+        ...     {'deadline': None, 'size': 1}, {'deadline': None, 'size': 2},
+        ...     {'deadline': 5, 'size': 0}]
+        >>> [j['size'] for j in sorted(jobs, key=_priority)]
+        [0, 2, 1]
+    """
+    return (job['deadline'] is None, job['deadline'], -job['size'])
+
+
+def _summarize(results, elapsed):
+    """Aggregates the :class:`IngestScheduler` job results."""
+    rows = sum(r['rows'] for r in results)
+    hosts = {}
+
+    for result in results:
+        summary = hosts.setdefault(
+            result['host'], {'jobs': 0, 'rows': 0, 'failed': 0})
+
+        summary['jobs'] += 1
+        summary['rows'] += result['rows']
+        summary['failed'] += 'error' in result
+
+    return {
+        'jobs': len(results),
+        'rows': rows,
+        'elapsed': elapsed,
+        'rows_per_sec': rows / elapsed if elapsed else 0,
+        'results': results,
+        'hosts': hosts,
+        'failed': [r for r in results if 'error' in r]}
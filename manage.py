@@ -58,6 +58,18 @@ def test(where=None, stop=False):
     call([p.join(_basedir, 'helpers', 'test'), opts])
 
 
+@manager.arg('output', 'o', help='JSON file to store results', default=None)
+@manager.arg(
+    'compare', 'c', help='JSON file of previous results', default=None)
+@manager.command
+def bench(output=None, compare=None):
+    """Run benchmarks against a local CKAN stand-in server"""
+    cmd = ['python', p.join(_basedir, 'bench.py')]
+    cmd += ['--output', output] if output else []
+    cmd += ['--compare', compare] if compare else []
+    call(cmd)
+
+
 @manager.command
 def register():
     """Register package with PyPI"""
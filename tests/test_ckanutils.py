@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+"""
+tests.test_ckanutils
+~~~~~~~~~~~~~~~~~~~~
+
+Provides ckanutils tests against the local CKAN stand-in server
+"""
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import bz2
+import gzip
+import json
+import time
+
+from functools import partial
+from os import path as p, makedirs, remove
+from shutil import rmtree
+from multiprocessing.pool import ThreadPool
+from tempfile import NamedTemporaryFile, mkdtemp
+
+from nose.tools import eq_, ok_, assert_raises
+from ckanapi import NotFound, CKANAPIError
+
+import bench
+
+from bench import FakeCKAN
+from ckanutils import (
+    CKAN, IngestScheduler, Metrics, Profiler, QueryCache, RetryPolicy,
+    replicate_table)
+
+FIELDS = [{'id': 'a', 'type': 'int'}, {'id': 'b', 'type': 'text'}]
+CSV = b'a,b\n1,one\n2,two\n3,three\n'
+
+
+def _ckan(server, **kwargs):
+    return CKAN(remote=server.address, api_key='bench', quiet=True, **kwargs)
+
+
+def _records(num):
+    return ({'a': i, 'b': 'row %i' % i} for i in range(num))
+
+
+def _write(suffix, content=CSV, opener=open):
+    f = NamedTemporaryFile(suffix=suffix, delete=False)
+    f.close()
+
+    with opener(f.name, 'wb') as g:
+        g.write(content)
+
+    return f.name
+
+
+def test_fake_ckan():
+    with FakeCKAN() as server:
+        rid = server.add_package('fake', 1)['resources'][0]['id']
+        ckan = _ckan(server)
+        ckan.create_table(rid, FIELDS)
+        ckan.insert_records(rid, _records(3))
+        result = ckan.datastore_search(resource_id=rid, offset=1, limit=1)
+        eq_(result['total'], 3)
+        eq_(result['records'], [{'_id': 2, 'a': 1, 'b': 'row 1'}])
+        ok_(server.requests > 0)
+
+
+def test_bench():
+    output = _write('.json', b'')
+    argv = [
+        '--rows', '20', '--chunksize', '10', '--packages', '2',
+        '--resources', '1', '--file-size', '1024', '--repeat', '1',
+        '--quiet', '--output', output]
+
+    try:
+        bench.main(argv)
+
+        with open(output) as f:
+            results = json.load(f)['results']
+    finally:
+        remove(output)
+
+    eq_(sorted(results), sorted(bench.BENCHMARKS))
+    ok_(all(result['rate'] > 0 for result in results.values()))
+
+
+def test_metrics():
+    events = []
+
+    with FakeCKAN() as server:
+        rid = server.add_package('metrics', 1)['resources'][0]['id']
+        metrics = Metrics(hooks=[events.append])
+        retry = RetryPolicy(2, backoff=0.01, jitter=False)
+        ckan = _ckan(server, metrics=metrics, retry=retry)
+        ckan.create_table(rid, FIELDS)
+        server.faults['datastore_upsert'] = [503]
+        ckan.insert_records(rid, _records(3))
+
+    stat = metrics.snapshot()['datastore_upsert']
+    eq_(stat['calls'], 2)
+    eq_(stat['retries'], 1)
+    eq_(sum(stat['errors'].values()), 1)
+    ok_(stat['sent'] > 0 and stat['received'] > 0)
+
+    upserts = [e for e in events if e['action'] == 'datastore_upsert']
+    eq_([e['event'] for e in upserts], ['call', 'retry', 'call'])
+    ok_(upserts[0]['error'] and not upserts[2]['error'])
+
+
+def test_bulk_insert():
+    with FakeCKAN() as server:
+        rid = server.add_package('bulk', 1)['resources'][0]['id']
+        metrics = Metrics()
+        ckan = _ckan(server, metrics=metrics)
+        ckan.create_table(rid, FIELDS)
+
+        kwargs = {'bulk': True, 'chunksize': 10, 'profile': True}
+        eq_(ckan.insert_records(rid, _records(25), **kwargs), 26)
+        eq_(metrics.snapshot()['datastore_upsert']['calls'], 3)
+        ok_('json_recode' not in ckan.last_profile['stages'])
+
+        # bulk loads are chunked by default
+        ckan.insert_records(rid, _records(3), bulk=True)
+        eq_(metrics.snapshot()['datastore_upsert']['calls'], 4)
+        eq_(len(server.tables[rid]['records']), 28)
+        ok_(not ckan.local)
+
+
+def test_profile():
+    filepath = _write('.csv')
+
+    try:
+        with FakeCKAN() as server:
+            rid = server.add_package('profile', 1)['resources'][0]['id']
+            ckan = _ckan(server)
+            kwargs = {'profile': True, 'tracemalloc': True}
+            eq_(ckan.update_datastore(rid, filepath, **kwargs), 4)
+    finally:
+        remove(filepath)
+
+    profile = ckan.last_profile
+    eq_(profile['rows'], 3)
+    ok_({'read', 'upsert'}.issubset(profile['stages']))
+
+    # memory tracing is released once the load is done
+    eq_(Profiler.tracers, 0)
+
+
+def test_rate_limit():
+    # 4 workers against a portal that allows 40 calls/s
+    capacity, calls = 40, 120
+
+    with FakeCKAN(capacity=capacity) as server:
+        server.add_package('limit')
+        retry = RetryPolicy(8, backoff=0.1)
+        ckan = _ckan(server, retry=retry, rate_limit=capacity)
+        server.rejected = 0
+        pool = ThreadPool(4)
+        start = time.time()
+
+        try:
+            pool.map(lambda _: ckan.package_show(id='limit'), range(calls))
+        finally:
+            pool.close()
+
+        elapsed = time.time() - start
+
+    # concurrent rejections only cut the rate once, so it recovers to near
+    # the capacity instead of a fraction of it
+    ok_(calls / elapsed > capacity * 0.6)
+    ok_(server.rejected < capacity)
+    ok_(ckan.limiter.rate > capacity / 2)
+
+
+def test_shadow_load():
+    with FakeCKAN() as server:
+        package = server.add_package('shadow', 1)
+        rid = package['resources'][0]['id']
+        ckan = _ckan(server)
+        ckan.create_table(rid, FIELDS, aliases=['shadow'])
+        ckan.insert_records(rid, _records(2))
+
+        # a second load must find the alias on the first shadow table
+        for num in [3, 5]:
+            shadow_id, count = ckan.shadow_load(
+                rid, FIELDS, _records(num), aliases=['shadow'])
+
+            eq_(count, num + 1)
+            eq_(ckan.get_alias_owner('shadow'), shadow_id)
+            eq_(ckan.last_shadow_id, shadow_id)
+            eq_(len(server.tables[shadow_id]['records']), num)
+
+        # the previous shadow table is removed along with its resource, but
+        # the resource's own table is still readable
+        eq_(sorted(server.tables), sorted([rid, shadow_id]))
+        eq_(len(package['resources']), 2)
+        eq_(ckan.datastore_search(resource_id=rid)['total'], 2)
+
+        shadow_id = ckan.shadow_load(
+            rid, FIELDS, _records(1), aliases=['shadow'], drop=True)[0]
+
+        eq_(sorted(server.tables), [shadow_id])
+        eq_(len(package['resources']), 2)
+
+
+def test_sync_directory():
+    path = mkdtemp()
+    makedirs(p.join(path, 'sub'))
+
+    for name in ['a.csv', p.join('sub', 'b.csv')]:
+        with open(p.join(path, name), 'wb') as f:
+            f.write(CSV)
+
+    try:
+        with FakeCKAN() as server:
+            package = server.add_package('sync')
+            ckan = _ckan(server)
+            summary = ckan.sync_directory('sync', path)
+            eq_(summary['created'], ['a.csv', 'sub/b.csv'])
+            eq_(summary['bytes_uploaded'], 2 * len(CSV))
+
+            summary = ckan.sync_directory('sync', path)
+            eq_(summary['skipped'], ['a.csv', 'sub/b.csv'])
+            eq_(summary['created'] + summary['updated'], [])
+            eq_(summary['bytes_saved'], 2 * len(CSV))
+
+            with open(p.join(path, 'a.csv'), 'ab') as f:
+                f.write(b'4,four\n')
+
+            summary = ckan.sync_directory('sync', path)
+            eq_(summary['updated'], ['a.csv'])
+            eq_(summary['skipped'], ['sub/b.csv'])
+
+            # the changed file's resource is updated in place
+            names = [r['name'] for r in package['resources']]
+            eq_(sorted(names), ['a.csv', 'sub/b.csv'])
+            eq_(ckan.sync_directory('sync', path)['skipped'], sorted(names))
+    finally:
+        rmtree(path)
+
+
+def test_compressed_input():
+    for suffix, opener in [('.csv.gz', gzip.open), ('.csv.bz2', bz2.BZ2File)]:
+        filepath = _write(suffix, opener=opener)
+
+        try:
+            with FakeCKAN() as server:
+                rid = server.add_package('compressed', 1)['resources'][0]['id']
+                ckan = _ckan(server)
+                eq_(ckan.update_datastore(rid, filepath), 4)
+                records = server.tables[rid]['records']
+                eq_([r['b'] for r in records], ['one', 'two', 'three'])
+        finally:
+            remove(filepath)
+
+
+def test_replicate_table():
+    with FakeCKAN() as server:
+        package = server.add_package('replicate', 2)
+        src_id, dst_id = [r['id'] for r in package['resources']]
+        ckan = _ckan(server)
+        ckan.create_table(src_id, FIELDS)
+        ckan.insert_records(src_id, _records(5))
+        args = (ckan, src_id, ckan, dst_id)
+        eq_(replicate_table(*args, pagesize=2), {'rows': 5, 'watermark': 5})
+
+        # incremental runs fall back to offset paging if sql is disabled
+        ckan.insert_records(src_id, _records(2))
+        server.sql = False
+        result = replicate_table(*args, since=5, pagesize=2)
+        eq_(result, {'rows': 2, 'watermark': 7})
+        eq_(len(server.tables[dst_id]['records']), 7)
+
+        # with `_id` gaps (2, 3, 4, 5, 7), a failed keyset page must not be
+        # refetched by offset
+        server.sql = True
+        ckan.delete_records(src_id, 'a', [0])
+        server.faults['datastore_search_sql'] = [0, 503]
+        assert_raises(CKANAPIError, replicate_table, *args, pagesize=2)
+
+        server.faults['datastore_search_sql'] = [0, 503]
+        retry = RetryPolicy(2, backoff=0.01, jitter=False)
+        args = (_ckan(server, retry=retry), src_id, ckan, dst_id)
+        eq_(replicate_table(*args, pagesize=2), {'rows': 5, 'watermark': 7})
+        records = server.tables[dst_id]['records']
+        eq_([r['a'] for r in records], [1, 2, 3, 4, 1])
+
+        args = (ckan, 'missing', ckan, dst_id)
+        assert_raises(NotFound, replicate_table, *args)
+
+
+def test_query_cache():
+    path = mkdtemp()
+
+    try:
+        with FakeCKAN() as server:
+            rid = server.add_package('cache', 1)['resources'][0]['id']
+            cache = QueryCache(path=p.join(path, 'cache'))
+            ckan = _ckan(server, cache=cache)
+            ckan.create_table(rid, FIELDS, aliases=['cached'])
+            ckan.insert_records(rid, _records(2))
+            search = partial(ckan.datastore_search, resource_id='cached')
+            eq_(search()['total'], 2)
+
+            requests = server.requests
+            eq_(search()['total'], 2)
+            eq_(server.requests, requests)
+
+            # inserting into the resource invalidates its alias' results
+            ckan.insert_records(rid, _records(1))
+            eq_(search()['total'], 3)
+
+            # the disk tier outlives the cache, and is invalidated as well
+            cache.close()
+            ckan.cache = cache = QueryCache(path=p.join(path, 'cache'))
+            requests = server.requests
+            eq_(search()['total'], 3)
+            eq_(server.requests, requests)
+
+            ckan.insert_records(rid, _records(1))
+            eq_(search()['total'], 4)
+            cache.close()
+    finally:
+        rmtree(path)
+
+
+def test_ingest_scheduler():
+    filepath = _write('.csv')
+
+    try:
+        with FakeCKAN() as server:
+            rids = [
+                r['id'] for r in server.add_package('ingest', 3)['resources']]
+
+            ckan = _ckan(server)
+            kwargs = {'workers': 2, 'max_rows': 4, 'host_rows': 2}
+            scheduler = IngestScheduler(ckan, **kwargs)
+
+            for rid in rids:
+                scheduler.add(rid, filepath)
+
+            scheduler.add('missing', filepath)
+            report = scheduler.run()
+            eq_(report['jobs'], 4)
+            eq_(report['rows'], 9)
+            eq_([r['resource_id'] for r in report['failed']], ['missing'])
+
+            # rows are released from the shared budget as they're written
+            eq_(scheduler.budget.rows, 0)
+
+            for rid in rids:
+                eq_(len(server.tables[rid]['records']), 3)
+    finally:
+        remove(filepath)
+
+
+def test_changes():
+    # portals may cap the page size below the requested one
+    with FakeCKAN(max_limit=2) as server:
+        packages = [server.add_package('p%i' % i, 1) for i in range(3)]
+        timestamps = ['2016-01-0%iT00:00:00.000000' % i for i in range(1, 6)]
+
+        for package, timestamp in zip(packages, timestamps):
+            server.add_activity(
+                package['id'], 'new package', timestamp=timestamp)
+
+        ckan = _ckan(server)
+        changes = list(ckan.changes(pagesize=5))
+        eq_(len(changes), 3)
+        eq_(changes[0]['pname'], 'p2')
+        eq_(ckan.last_cursor, timestamps[2])
+
+        resource = packages[0]['resources'][0]
+        server.add_activity(
+            packages[0]['id'], revision_id=resource['revision_id'],
+            timestamp=timestamps[3])
+
+        server.add_activity(
+            packages[1]['id'], 'deleted package', timestamp=timestamps[4])
+
+        changes = list(ckan.changes(since=ckan.last_cursor))
+        eq_([c['change'] for c in changes], ['deleted', 'changed'])
+        eq_(changes[1]['rid'], resource['id'])
+        eq_(ckan.last_cursor, timestamps[4])
+
+
+def test_reuse_table():
+    with FakeCKAN() as server:
+        rid = server.add_package('reuse', 1)['resources'][0]['id']
+        metrics = Metrics()
+        ckan = _ckan(server, metrics=metrics)
+
+        # a missing table is created without trying to delete it
+        eq_(ckan.reuse_table(rid, FIELDS), 'recreated')
+        ok_('datastore_delete' not in metrics.snapshot())
+
+        ckan.insert_records(rid, _records(3))
+        eq_(ckan.reuse_table(rid, FIELDS), 'reused')
+        eq_(server.tables[rid]['records'], [])
+        ok_(server.resources[rid]['datastore_active'])
+
+        fields = [{'id': 'c', 'type': 'text'}] + FIELDS
+        eq_(ckan.reuse_table(rid, fields), 'altered')
+        eq_([f['id'] for f in server.tables[rid]['fields']], ['a', 'b', 'c'])
+        ok_(server.resources[rid]['datastore_active'])
+
+        fields = [{'id': 'a', 'type': 'text'}]
+        eq_(ckan.reuse_table(rid, fields), 'recreated')
+
+
+def test_delete_tables():
+    with FakeCKAN() as server:
+        rids = [r['id'] for r in server.add_package('delete', 2)['resources']]
+        ckan = _ckan(server)
+
+        for rid in rids:
+            ckan.create_table(rid, FIELDS)
+            ckan.insert_records(rid, _records(5))
+
+        outcome = ckan.delete_records(rids[0], 'a', range(3), batchsize=2)
+        eq_(outcome, {'status': 'deleted', 'requests': 2})
+        eq_([r['a'] for r in server.tables[rids[0]]['records']], [3, 4])
+
+        outcomes = ckan.delete_tables([rids[1], 'missing'])
+        eq_(outcomes[rids[1]]['status'], 'deleted')
+        eq_(outcomes['missing']['status'], 'not found')
+        ok_(rids[1] not in server.tables)